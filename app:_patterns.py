@@ -0,0 +1,36 @@
+"""
+Precompiled regular expressions shared by the outline parser and generator
+"""
+
+import re
+
+# Numbered segment heading, e.g. "1. Introduction (15 min)"; group 1 is the title
+SEGMENT_TITLE_RE = re.compile(r'^\s*\d+\.\s+(.*?)(?:\s+\(\d+\s*(?:min|minutes)\)|\s*$)', re.MULTILINE)
+
+# Start of a numbered segment heading line, for locating segments in full text
+SEGMENT_START_RE = re.compile(r'^[ \t]*\d+\.[ \t]+.+$', re.MULTILINE)
+
+# Segment duration in parentheses; group 1 is the number of minutes
+DURATION_RE = re.compile(r'\((\d+)\s*(?:min|minutes)\)')
+
+# Bullet point subsection; group 1 is the text
+SUBSECTION_RE = re.compile(r'^\s*•\s+(.*?)$')
+
+# Break segments
+BREAK_RE = re.compile(r'break|pause|rest', re.IGNORECASE)
+
+# Any numbered line
+NUMBERED_SECTION_RE = re.compile(r'^\s*\d+\.', re.MULTILINE)
+
+# Segment type classifier for lowercased titles. Branches are tried in order,
+# so a title matching several keyword groups gets the first type listed.
+SEGMENT_TYPE_RE = re.compile(r"""
+    ^(?:
+        (?=.*(?:introduction|welcome))(?P<introduction>)
+      | (?=.*(?:break|pause))(?P<break>)
+      | (?=.*(?:conclusion|closing|summary))(?P<conclusion>)
+      | (?=.*(?:activity|exercise|workshop))(?P<activity>)
+      | (?=.*discussion)(?P<discussion>)
+      | (?=.*(?:presentation|lecture))(?P<presentation>)
+    )
+""", re.VERBOSE)
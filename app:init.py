@@ -12,46 +12,90 @@ from datetime import datetime
 from typing import List, Dict, Any, Optional
 
 # Flask for web framework
-from flask import Flask, request, jsonify, render_template, redirect, url_for, send_file
+from flask import Flask, request, jsonify, render_template, redirect, url_for, send_file, Response, stream_with_context
 from flask_cors import CORS
+from flask_compress import Compress
+from flask.json import JSONEncoder
+import orjson
 
 # Database
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 # Vector database for embeddings
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
 # NLP and embedding generation
 import nltk
 from nltk.tokenize import sent_tokenize, word_tokenize
 import openai  # For GPT integration
+import requests
+from requests.adapters import HTTPAdapter
 
 # PDF and DOCX handling (import/export)
 from docx import Document
 from fpdf import FPDF
-import PyPDF2
+import pypdfium2 as pdfium
+
+# Settings per environment (FLASK_ENV), also loads .env
+from config import get_config
+
+class OrjsonEncoder(JSONEncoder):
+    """Flask JSON encoder that serializes with orjson"""
+    
+    def encode(self, o):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(o, default=self.default, option=option).decode('utf-8')
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json_encoder = OrjsonEncoder
 CORS(app)  # Enable CORS for all routes
+# gzip/brotli responses when the client accepts them. Besides Flask-Compress's
+# defaults this covers plain-text exports; PDF (deflated page streams) and
+# DOCX (a zip archive) exports are already compressed and are sent as-is.
+app.config['COMPRESS_MIMETYPES'] = [
+    'text/html', 'text/css', 'text/xml', 'text/plain',
+    'application/json', 'application/javascript'
+]
+Compress(app)
 
-# Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///outline_generator.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev_key_for_session_management')
-app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-app.config['OPENAI_API_KEY'] = os.environ.get('OPENAI_API_KEY', '')
+# Configuration: the class for FLASK_ENV from config.py. Without FLASK_ENV
+# the production settings apply, which require SECRET_KEY.
+app.config.from_object(get_config())
 
 # Initialize extensions
 db = SQLAlchemy(app)
-openai.api_key = app.config['OPENAI_API_KEY']
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# SQLite: WAL lets readers proceed alongside a writer, and with
+# synchronous=NORMAL commits no longer wait on an fsync
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-64000',  # 64 MB
+)
 
-# Download NLTK data (if needed)
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt')
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+# Share one pooled HTTPS session across OpenAI calls so connections (and TLS
+# handshakes) are reused; callers pass their API key per request
+openai_session = requests.Session()
+openai_session.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=100))
+openai.requestssession = openai_session
+
+# Ensure upload and embedding index directories exist
+os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['EMBEDDING_INDEX_FOLDER'], exist_ok=True)
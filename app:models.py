@@ -2,24 +2,68 @@
 Database models for the Programme Outline Generator
 """
 
+from collections import namedtuple
 from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple
+import orjson
+from sqlalchemy import func, select
 from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.types import TypeDecorator, Text
 from app import db  # Import from the main app
 
+class OrjsonText(TypeDecorator):
+    """JSON stored as text, encoded and decoded with orjson"""
+    impl = Text
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return orjson.dumps(value).decode('utf-8')
+    
+    def process_result_value(self, value, dialect):
+        # Drivers that decode JSON columns themselves (psycopg2) hand back objects
+        if value is None or not isinstance(value, (str, bytes)):
+            return value
+        return orjson.loads(value)
+
+# Columns of a reference outline read on the generation path
+ReferenceSummary = namedtuple('ReferenceSummary', ['id', 'title', 'content', 'tokens', 'updated_at'])
+
 class ReferenceOutline(db.Model):
     """Model for preloaded reference outlines"""
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=True)
     content = db.Column(db.Text, nullable=False)  # Full outline content
-    structure = db.Column(JSON, nullable=False)   # Parsed structure (segments, durations, etc.)
+    structure = db.Column(OrjsonText, nullable=False)   # Parsed structure (segments, durations, etc.)
     embedding = db.Column(db.PickleType, nullable=True)  # Vector embedding for similarity search
+    tokens = db.Column(db.PickleType, nullable=True)  # Token IDs of content for prompt budgeting
+    style_json = db.Column(OrjsonText, nullable=True)  # Format style, precomputed at ingest
+    style_bits = db.Column(db.SmallInteger, nullable=True)  # Boolean style flags packed into a bitmask at ingest
+    patterns_json = db.Column(OrjsonText, nullable=True)  # Segment patterns, precomputed at ingest
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def __repr__(self):
         return f'<ReferenceOutline {self.title}>'
 
+    @classmethod
+    def load_many_structures(cls, ids: Optional[List[int]] = None) -> Dict[int, Dict[str, Any]]:
+        """
+        Load parsed structures in one query without hydrating full rows.
+        
+        Args:
+            ids: Reference outline IDs to load, or None for all
+            
+        Returns:
+            Dictionary mapping outline ID to its structure
+        """
+        query = db.session.query(cls.id, cls.structure)
+        if ids is not None:
+            query = query.filter(cls.id.in_(ids))
+        return {outline_id: structure or {} for outline_id, structure in query}
+
     def to_dict(self):
         """Convert to dictionary for API responses"""
         return {
@@ -30,6 +74,45 @@ class ReferenceOutline(db.Model):
             'updated_at': self.updated_at.isoformat()
         }
 
+def fetch_reference_summaries(ids: Optional[List[int]] = None, limit: Optional[int] = None) -> List[ReferenceSummary]:
+    """
+    Fetch the columns needed for generation without hydrating ORM objects.
+    
+    Args:
+        ids: Reference outline IDs to fetch, or None for any
+        limit: Maximum number of summaries to return
+        
+    Returns:
+        List of reference summaries, in the order of ids when given
+    """
+    statement = select(ReferenceOutline.id, ReferenceOutline.title, ReferenceOutline.content,
+                       ReferenceOutline.tokens, ReferenceOutline.updated_at)
+    if ids is not None:
+        statement = statement.where(ReferenceOutline.id.in_(ids))
+    if limit is not None:
+        statement = statement.limit(limit)
+    
+    # Stream rows instead of buffering the whole result in the driver
+    result = db.session.execute(statement.execution_options(stream_results=True)).yield_per(100)
+    summaries = [ReferenceSummary(*row) for row in result]
+    
+    if ids is not None:
+        position = {outline_id: i for i, outline_id in enumerate(ids)}
+        summaries.sort(key=lambda summary: position.get(summary.id, len(ids)))
+    return summaries
+
+def fetch_reference_version() -> Tuple[int, Optional[datetime]]:
+    """
+    Version of the stored reference outlines, read from the database so it
+    reflects writes made by any process. Every ORM write bumps updated_at,
+    and deletes change the count.
+    
+    Returns:
+        Tuple of the number of reference outlines and their latest updated_at
+    """
+    count, latest = db.session.query(func.count(ReferenceOutline.id), func.max(ReferenceOutline.updated_at)).one()
+    return count, latest
+
 class GeneratedOutline(db.Model):
     """Model for outlines generated by users"""
     id = db.Column(db.Integer, primary_key=True)
@@ -62,6 +145,20 @@ class GeneratedOutline(db.Model):
             'updated_at': self.updated_at.isoformat()
         }
 
+class CachedOutline(db.Model):
+    """Model for generated outlines cached by generation prompt"""
+    id = db.Column(db.Integer, primary_key=True)
+    prompt_hash = db.Column(db.String(64), unique=True, index=True, nullable=False)  # SHA-256 of the prompt, model and max_tokens
+    embedding = db.Column(db.PickleType, nullable=True)  # Normalized specification embedding for similarity lookup
+    model = db.Column(db.String(50), nullable=True)  # Generation model; similarity matches require the same one
+    total_duration = db.Column(db.Integer, nullable=True)  # Requested duration; similarity matches require the same one
+    segment_count = db.Column(db.Integer, nullable=True)  # Requested segment count; similarity matches require the same one
+    content = db.Column(db.Text, nullable=False)  # Generated outline content
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CachedOutline {self.prompt_hash[:12]}>'
+
 class User(db.Model):
     """Basic user model for authentication and outline ownership"""
     id = db.Column(db.Integer, primary_key=True)
@@ -5,20 +5,125 @@ Uses Retrieval-Augmented Generation to create new outlines based on
 reference styles and user specifications.
 """
 
-import json
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future
+from collections import OrderedDict
+import numpy as np
 import openai
-from typing import Dict, List, Any, Optional
+from jinja2 import Environment, DictLoader
+from sqlalchemy.orm import Session
+from typing import Dict, List, Any, Optional, Tuple, Iterator, Union
 
-from app import app
-from app.models import ReferenceOutline, GeneratedOutline
+from app import app, db
+from app.models import ReferenceOutline, ReferenceSummary, CachedOutline
+from app._patterns import SEGMENT_START_RE
+from app.reference_corpus import reference_corpus, get_token_encoding, STYLE_FLAGS
+
+# Maximum prompt size in tokens; reference examples fill whatever the fixed
+# parts of the prompt leave over
+PROMPT_TOKEN_BUDGET = 6000
+
+# Generation models. Short, loosely styled outlines are routed to the faster
+# model; specifications['model'] overrides the choice.
+GENERATION_MODEL = "gpt-4-turbo-preview"
+FAST_GENERATION_MODEL = "gpt-4o-mini"
+
+# Number of distinct reference sets whose extracted data is kept in memory
+REFERENCE_DATA_CACHE_SIZE = 64
+
+# Number of generated outlines kept in memory for cache lookups
+OUTLINE_CACHE_SIZE = 2048
+
+# Generation prompt templates. The base template holds the fixed structure;
+# each style adherence bucket fills in the reference examples block.
+PROMPT_TEMPLATE_SOURCES = {
+    'base': """
+Create a workshop programme outline with the following specifications:
+
+TITLE: {{ title }}
+
+WORKSHOP OBJECTIVES:
+{{ objectives }}
+
+TOTAL DURATION: {{ total_duration }} minutes
+
+REQUIRED SEGMENTS:
+{% for seg in segments if seg.title %}- {{ seg.title }}{% if seg.duration %} ({{ seg.duration }} min){% endif %}: {{ seg.description }}{{ "\\n" if not loop.last }}{% else %}No specific segment requirements.{% endfor %}
+
+STYLE GUIDELINES:
+{% set cap_style = style.get('capitalization', 'title_case') %}{% if style.get('uses_bullets', False) %}- Use bullet points (•) for subsections
+{% endif %}{% if style.get('uses_numbered_sections', True) %}- Use numbered sections (1., 2., etc.) for main segments
+{% endif %}{% if style.get('uses_timing', True) %}- Include duration in minutes for each segment in parentheses
+{% endif %}{% if cap_style == 'uppercase' %}- Use UPPERCASE for main section titles
+{% elif cap_style == 'title_case' %}- Use Title Case for main section titles
+{% endif %}{% if style.get('uses_colons', False) %}- Use colons after section titles
+{% endif %}
+
+Your task is to create a complete workshop outline that follows the style and structure of the reference examples with a style adherence level of {{ style_adherence * 100 }}%. 
+The outline should incorporate all the specified objectives and segment requirements while maintaining the total duration of {{ total_duration }} minutes.
+{% block examples %}{% endblock %}{% if patterns %}
+COMMON PATTERNS:
+{% if patterns.common_durations %}- Typical durations: {{ patterns.common_durations|join(', ') }} minutes
+{% endif %}{% if patterns.segment_types %}- Typical segment types: {{ patterns.segment_types|join(', ') }}
+{% endif %}{% endif %}
+
+IMPORTANT FORMATTING INSTRUCTIONS:
+1. Pay careful attention to the numbering and indentation patterns in the reference examples
+2. Maintain the exact same format for specifying durations (e.g., "(15 min)" or "(15 minutes)")
+3. Use consistent capitalization and punctuation as shown in the references
+4. Follow the bullet point style exactly as shown in the references
+5. Preserve any special sections like introductions, breaks, or closing segments in the same style
+
+Generate ONLY the outline itself without additional explanations or comments.
+""",
+    # style_adherence <= 0.5: style guidelines only
+    'style_only': """{% extends 'base' %}""",
+    # 0.5 < style_adherence <= 0.7 (or a single reference): first example only
+    'single_example': """{% extends 'base' %}{% block examples %}
+REFERENCE EXAMPLE:
+
+{{ examples[0] }}
+
+{% endblock %}""",
+    # style_adherence > 0.7: up to three examples
+    'multiple_examples': """{% extends 'base' %}{% block examples %}
+REFERENCE EXAMPLES:
+
+{% for example in examples %}EXAMPLE {{ loop.index }}:
+{{ example }}
+{{ "\\n" if not loop.last }}{% endfor %}
+{% endblock %}""",
+}
+
+PROMPT_ENVIRONMENT = Environment(loader=DictLoader(PROMPT_TEMPLATE_SOURCES), cache_size=-1, keep_trailing_newline=True)
+
+def generation_key(prompt: str, model: str, max_tokens: int) -> str:
+    """SHA-256 hex digest identifying a generation request: its prompt, model and max_tokens"""
+    return hashlib.sha256(f"{model}\n{max_tokens}\n{prompt}".encode('utf-8')).hexdigest()
 
 class OutlineGenerator:
     """
     Generate new workshop outlines using a RAG approach.
     """
     
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, cache=None):
         self.api_key = api_key or app.config['OPENAI_API_KEY']
+        self.cache = cache or OutlineCache(api_key=self.api_key)
+        self._reference_data_cache: OrderedDict = OrderedDict()
+        self._prompt_templates = {
+            bucket: PROMPT_ENVIRONMENT.get_template(bucket)
+            for bucket in ('style_only', 'single_example', 'multiple_examples')
+        }
+        
+        # Generations in progress, keyed by prompt hash, so identical
+        # concurrent requests share one GPT call. Shared by the threaded and
+        # async paths: each async request runs in its own event loop, so
+        # only a thread-safe Future can be awaited across them
+        self._in_flight: Dict[str, Future] = {}
+        self._in_flight_lock = threading.Lock()
         
     def generate_outline(self, 
                          specifications: Dict[str, Any], 
@@ -35,153 +140,373 @@ class OutlineGenerator:
         Returns:
             Generated outline text
         """
-        # Extract key specifications
-        title = specifications.get('title', 'Workshop Outline')
-        objectives = specifications.get('objectives', '')
-        total_duration = specifications.get('total_duration', 120)  # Default 2 hours
-        segments = specifications.get('segments', [])
-        
-        # Extract style and structure information from references
-        reference_data = self._extract_reference_data(reference_outlines)
+        prompt = self._prepare_generation_prompt(specifications, reference_outlines, style_adherence)
+        model, max_tokens = self._route_generation(specifications, style_adherence)
+        key = generation_key(prompt, model, max_tokens)
         
-        # Build the prompt for the GPT model
-        prompt = self._build_generation_prompt(
-            title, objectives, total_duration, segments, reference_data, style_adherence
-        )
+        try:
+            # Return a cached outline for identical or near-identical requests
+            cached_outline = self.cache.lookup(key, specifications, model)
+            if cached_outline is not None:
+                return cached_outline
+            
+            # Wait for an identical generation that is already running
+            future, is_leader = self._join_in_flight(key)
+            if not is_leader:
+                return future.result()
+            
+            try:
+                generated_outline = self._complete_outline(prompt, model, max_tokens, specifications)
+                future.set_result(generated_outline)
+                return generated_outline
+            except BaseException as e:
+                # Waiting requests get the leader's error rather than a CancelledError
+                future.set_exception(e)
+                raise
+            finally:
+                self._leave_in_flight(key)
+        finally:
+            self.cache.discard(key)
+    
+    def _join_in_flight(self, key: str) -> Tuple[Future, bool]:
+        """
+        Find the generation in progress for a prompt hash, or register a new one.
         
+        Args:
+            key: Prompt hash from generation_key
+            
+        Returns:
+            The generation's Future, and whether the caller must run it
+        """
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future, False
+            
+            future = self._in_flight[key] = Future()
+            # A waiter that gives up (e.g. a cancelled async request) must not
+            # cancel the generation for everyone else
+            future.set_running_or_notify_cancel()
+            return future, True
+    
+    def _leave_in_flight(self, key: str):
+        """Unregister a finished generation so later requests start a new one"""
+        with self._in_flight_lock:
+            self._in_flight.pop(key, None)
+    
+    def _complete_outline(self, prompt: str, model: str, max_tokens: int, specifications: Dict[str, Any]) -> str:
+        """Call GPT for a generation prompt and cache the result"""
         try:
             # Generate the outline using GPT
             response = openai.ChatCompletion.create(
-                model="gpt-4-turbo-preview",  # Or appropriate model
-                messages=[
-                    {"role": "system", "content": "You are a specialized assistant that creates workshop programme outlines. You strictly adhere to the style and structure of reference outlines. Pay close attention to the formatting, segment structure, and language style of the references."},
-                    {"role": "user", "content": prompt}
-                ],
+                api_key=self.api_key,
+                model=model,
+                messages=self._generation_messages(prompt),
                 temperature=0.4,  # Lower temperature for more predictable outputs
-                max_tokens=2000
+                max_tokens=max_tokens
             )
             
             generated_outline = response.choices[0].message.content.strip()
+            self.cache.store(generation_key(prompt, model, max_tokens), specifications, model, generated_outline)
             return generated_outline
             
         except Exception as e:
             app.logger.error(f"Error generating outline: {str(e)}")
             return f"Error generating outline: {str(e)}"
     
-    def _extract_reference_data(self, reference_outlines: List[ReferenceOutline]) -> Dict[str, Any]:
-        """Extract style and structure data from reference outlines"""
-        if not reference_outlines:
-            return {"style": "standard", "examples": []}
+    def stream_outline(self, 
+                       specifications: Dict[str, Any], 
+                       reference_outlines: List[ReferenceOutline],
+                       style_adherence: float = 0.8) -> Iterator[str]:
+        """
+        Generate a new outline, yielding text as the model produces it.
+        
+        Args:
+            specifications: User requirements including objectives, duration, etc.
+            reference_outlines: List of reference outlines to base style on
+            style_adherence: 0-1 float indicating how closely to follow reference style
+            
+        Yields:
+            Chunks of generated outline text
+        """
+        prompt = self._prepare_generation_prompt(specifications, reference_outlines, style_adherence)
+        model, max_tokens = self._route_generation(specifications, style_adherence)
+        key = generation_key(prompt, model, max_tokens)
+        
+        try:
+            cached_outline = self.cache.lookup(key, specifications, model)
+            if cached_outline is not None:
+                yield cached_outline
+                return
+            
+            parts = []
+            try:
+                response = openai.ChatCompletion.create(
+                    api_key=self.api_key,
+                    model=model,
+                    messages=self._generation_messages(prompt),
+                    temperature=0.4,
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+                
+                for chunk in response:
+                    content = chunk.choices[0].delta.get('content')
+                    if content:
+                        parts.append(content)
+                        yield content
+                
+            except Exception as e:
+                app.logger.error(f"Error streaming outline: {str(e)}")
+                yield f"Error generating outline: {str(e)}"
+                return
+            
+            self.cache.store(key, specifications, model, "".join(parts).strip())
+        finally:
+            # Also runs when the client disconnects mid-stream
+            self.cache.discard(key)
+    
+    async def agenerate_outline(self, 
+                                specifications: Dict[str, Any], 
+                                reference_outlines: List[ReferenceOutline],
+                                style_adherence: float = 0.8) -> str:
+        """
+        Async variant of generate_outline so concurrent requests overlap
+        network latency instead of blocking a worker per call.
+        
+        Args:
+            specifications: User requirements including objectives, duration, etc.
+            reference_outlines: List of reference outlines to base style on
+            style_adherence: 0-1 float indicating how closely to follow reference style
             
-        # Extract format styles
-        styles = []
-        examples = []
-        segments_by_outline = {}
-        
-        for outline in reference_outlines:
-            # Extract the structure
-            structure = outline.structure if outline.structure else {}
+        Returns:
+            Generated outline text
+        """
+        prompt = self._prepare_generation_prompt(specifications, reference_outlines, style_adherence)
+        model, max_tokens = self._route_generation(specifications, style_adherence)
+        key = generation_key(prompt, model, max_tokens)
+        
+        try:
+            # Return a cached outline for identical or near-identical requests
+            cached_outline = await self.cache.alookup(key, specifications, model)
+            if cached_outline is not None:
+                return cached_outline
             
-            # Get format style
-            style = structure.get('format_style', {})
-            if style:
-                styles.append(style)
+            # Wait for an identical generation that is already running, in
+            # another request's event loop or in a worker thread
+            future, is_leader = self._join_in_flight(key)
+            if not is_leader:
+                return await asyncio.wrap_future(future)
+            
+            try:
+                generated_outline = await self._acomplete_outline(prompt, model, max_tokens, specifications)
+                future.set_result(generated_outline)
+                return generated_outline
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                self._leave_in_flight(key)
+        finally:
+            self.cache.discard(key)
+    
+    async def _acomplete_outline(self, prompt: str, model: str, max_tokens: int, specifications: Dict[str, Any]) -> str:
+        """Call GPT asynchronously for a generation prompt and cache the result"""
+        try:
+            response = await openai.ChatCompletion.acreate(
+                api_key=self.api_key,
+                model=model,
+                messages=self._generation_messages(prompt),
+                temperature=0.4,
+                max_tokens=max_tokens
+            )
             
-            # Add content as example
-            examples.append(outline.content)
+            generated_outline = response.choices[0].message.content.strip()
+            await self.cache.astore(generation_key(prompt, model, max_tokens), specifications, model, generated_outline)
+            return generated_outline
             
-            # Store segments for more detailed analysis
-            if 'segments' in structure:
-                segments_by_outline[outline.id] = structure['segments']
+        except Exception as e:
+            app.logger.error(f"Error generating outline: {str(e)}")
+            return f"Error generating outline: {str(e)}"
+    
+    async def abatch_generate(self, 
+                              list_of_specs: List[Dict[str, Any]], 
+                              reference_outlines: List[ReferenceOutline],
+                              style_adherence: float = 0.8) -> List[str]:
+        """
+        Generate several outlines concurrently against the same references.
+        
+        Args:
+            list_of_specs: One specifications dictionary per outline
+            reference_outlines: Reference outlines shared by every outline
+            style_adherence: 0-1 float indicating how closely to follow reference style
+            
+        Returns:
+            Generated outline texts, in the same order as list_of_specs
+        """
+        return await asyncio.gather(*(
+            self.agenerate_outline(specs, reference_outlines, style_adherence)
+            for specs in list_of_specs
+        ))
+    
+    def _prepare_generation_prompt(self, 
+                                   specifications: Dict[str, Any], 
+                                   reference_outlines: List[ReferenceOutline],
+                                   style_adherence: float) -> str:
+        """Build the generation prompt from specifications and references"""
+        # Extract key specifications
+        title = specifications.get('title', 'Workshop Outline')
+        objectives = specifications.get('objectives', '')
+        total_duration = specifications.get('total_duration', 120)  # Default 2 hours
+        segments = specifications.get('segments', [])
+        
+        # Extract style and structure information from references
+        reference_data = self._extract_reference_data(reference_outlines)
+        
+        # Build the prompt for the GPT model
+        return self._build_generation_prompt(
+            title, objectives, total_duration, segments, reference_data, style_adherence
+        )
+    
+    def _route_generation(self, specifications: Dict[str, Any], style_adherence: float) -> Tuple[str, int]:
+        """
+        Choose the model and completion budget for a generation request.
+        
+        Args:
+            specifications: User requirements including objectives, duration, etc.
+            style_adherence: 0-1 float indicating how closely to follow reference style
+            
+        Returns:
+            Tuple of model name and max_tokens
+        """
+        total_duration = specifications.get('total_duration', 120)
+        segments = specifications.get('segments', [])
+        
+        model = specifications.get('model')
+        if not model:
+            is_simple = total_duration <= 60 and len(segments) <= 3 and style_adherence < 0.7
+            model = FAST_GENERATION_MODEL if is_simple else GENERATION_MODEL
+        max_tokens = min(2000, 200 + 40 * total_duration)
+        
+        # Logged so routing can be evaluated against outline quality offline
+        app.logger.info(
+            f"Generating outline with {model} (max_tokens={max_tokens}, duration={total_duration}, "
+            f"segments={len(segments)}, style_adherence={style_adherence})"
+        )
+        return model, max_tokens
+    
+    def _generation_messages(self, prompt: str) -> List[Dict[str, str]]:
+        """Chat messages for a full outline generation request"""
+        return [
+            {"role": "system", "content": "You are a specialized assistant that creates workshop programme outlines. You strictly adhere to the style and structure of reference outlines. Pay close attention to the formatting, segment structure, and language style of the references."},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _extract_reference_data(self, reference_outlines: List[Union[ReferenceOutline, ReferenceSummary]]) -> Dict[str, Any]:
+        """
+        Extract style and structure data from reference outlines, memoized per reference set.
+        
+        Accepts ORM objects or the lighter summaries from fetch_reference_summaries;
+        only id, content, tokens and updated_at are read.
+        """
+        if not reference_outlines:
+            return {"style": {}, "examples": []}
+        
+        # Order matters (examples, typical sequence), so the key keeps it;
+        # updated_at changes whenever a reference is written
+        key = tuple((outline.id, outline.updated_at) for outline in reference_outlines)
+        
+        reference_data = self._reference_data_cache.get(key)
+        if reference_data is not None:
+            self._reference_data_cache.move_to_end(key)
+            return reference_data
+        
+        reference_data = self._compute_reference_data(reference_outlines)
+        self._reference_data_cache[key] = reference_data
+        if len(self._reference_data_cache) > REFERENCE_DATA_CACHE_SIZE:
+            self._reference_data_cache.popitem(last=False)
+        return reference_data
+    
+    def _compute_reference_data(self, reference_outlines: List[Union[ReferenceOutline, ReferenceSummary]]) -> Dict[str, Any]:
+        """Extract style and structure data from reference outlines"""
+        # Add content as examples
+        examples = [outline.content for outline in reference_outlines]
+        example_tokens = [self._reference_tokens(outline) for outline in reference_outlines]
+        
+        # Style and segment columns for these references
+        corpus = reference_corpus.select([(outline.id, outline.updated_at) for outline in reference_outlines])
         
         # Determine the dominant style by merging
-        dominant_style = self._merge_styles(styles) if styles else {}
+        has_style = corpus['has_style']
+        dominant_style = (
+            self._merge_styles(corpus['style_flags'][has_style], corpus['capitalization'][has_style])
+            if has_style.any() else {}
+        )
         
         # Extract common structural patterns from segments
-        segment_patterns = self._extract_segment_patterns(segments_by_outline)
+        segment_patterns = self._extract_segment_patterns(corpus)
         
         return {
             "style": dominant_style,
             "examples": examples,
+            "example_tokens": example_tokens,
             "segment_patterns": segment_patterns
         }
-        
-    def _extract_segment_patterns(self, segments_by_outline):
+    
+    def _extract_segment_patterns(self, corpus: Dict[str, np.ndarray]) -> Dict[str, Any]:
         """Extract common patterns from segments across outlines"""
         # This function analyzes segments to find common patterns
         # Important for RAG to understand PDF-extracted content structure
+        durations = corpus['durations']
+        segment_types = corpus['segment_types']
         
         patterns = {
-            "common_durations": set(),
-            "segment_types": set(),
+            "common_durations": np.unique(durations[durations > 0]).tolist(),
+            "segment_types": np.unique(segment_types[segment_types != '']).tolist(),
             "typical_sequence": []
         }
         
-        # Collect common durations
-        for outline_id, segments in segments_by_outline.items():
-            for segment in segments:
-                if 'duration' in segment and segment['duration'] > 0:
-                    patterns["common_durations"].add(segment['duration'])
-                
-                # Detect segment type from title
-                title = segment.get('title', '').lower()
-                if 'introduction' in title or 'welcome' in title:
-                    patterns["segment_types"].add("introduction")
-                elif 'break' in title or 'pause' in title:
-                    patterns["segment_types"].add("break")
-                elif 'conclusion' in title or 'closing' in title or 'summary' in title:
-                    patterns["segment_types"].add("conclusion")
-                elif 'activity' in title or 'exercise' in title or 'workshop' in title:
-                    patterns["segment_types"].add("activity")
-                elif 'discussion' in title:
-                    patterns["segment_types"].add("discussion")
-                elif 'presentation' in title or 'lecture' in title:
-                    patterns["segment_types"].add("presentation")
-        
-        # Convert sets to lists for JSON serialization
-        patterns["common_durations"] = list(sorted(patterns["common_durations"]))
-        patterns["segment_types"] = list(patterns["segment_types"])
-        
-        # Detect typical sequence (if any)
-        if segments_by_outline:
-            # Use the first outline as a template for sequence
-            first_outline_id = next(iter(segments_by_outline))
-            patterns["typical_sequence"] = [
-                seg.get('title', '').lower() 
-                for seg in segments_by_outline[first_outline_id]
-            ]
+        # Use the first outline with segments as a template for sequence
+        counts = corpus['segment_counts']
+        with_segments = np.flatnonzero(counts)
+        if len(with_segments):
+            first = with_segments[0]
+            start = int(counts[:first].sum())
+            patterns["typical_sequence"] = corpus['titles'][start:start + counts[first]].tolist()
             
         return patterns
     
-    def _merge_styles(self, styles: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def _merge_styles(self, style_flags: np.ndarray, capitalization: np.ndarray) -> Dict[str, Any]:
         """Merge multiple format styles to determine the dominant style"""
-        if not styles:
+        if not len(style_flags):
             return {}
-            
-        # Count style features
-        uses_bullets = sum(1 for s in styles if s.get('uses_bullets', False))
-        uses_numbered = sum(1 for s in styles if s.get('uses_numbered_sections', False))
-        uses_timing = sum(1 for s in styles if s.get('uses_timing', False))
-        uses_colons = sum(1 for s in styles if s.get('uses_colons', False))
         
-        # Count capitalization styles
-        cap_styles = {}
-        for s in styles:
-            cap = s.get('capitalization', 'unknown')
-            cap_styles[cap] = cap_styles.get(cap, 0) + 1
+        # Count style features: one bit per flag, in STYLE_FLAGS order
+        bits = np.unpackbits(style_flags.reshape(-1, 1), axis=1, bitorder='little')
+        dominant = bits[:, :len(STYLE_FLAGS)].sum(axis=0) > len(style_flags) / 2
         
-        # Determine dominant capitalization
-        dominant_cap = max(cap_styles.items(), key=lambda x: x[1])[0] if cap_styles else "title_case"
+        # Determine dominant capitalization; on a tie, the style seen first wins
+        cap_values, first_seen, cap_counts = np.unique(
+            capitalization.astype(str), return_index=True, return_counts=True)
+        dominant_cap = cap_values[np.lexsort((first_seen, -cap_counts))[0]]
         
         # Return merged style
-        return {
-            "uses_bullets": uses_bullets > len(styles) / 2,
-            "uses_numbered_sections": uses_numbered > len(styles) / 2,
-            "uses_timing": uses_timing > len(styles) / 2,
-            "capitalization": dominant_cap,
-            "uses_colons": uses_colons > len(styles) / 2
-        }
+        merged = {flag: bool(is_dominant) for flag, is_dominant in zip(STYLE_FLAGS, dominant)}
+        merged["capitalization"] = str(dominant_cap)
+        return merged
     
+    def _get_encoding(self):
+        """The tokenizer used for prompt budgeting"""
+        return get_token_encoding()
+    
+    def _reference_tokens(self, outline: Union[ReferenceOutline, ReferenceSummary]) -> List[int]:
+        """Token IDs for a reference outline's content, as stored at ingest"""
+        if outline.tokens is not None:
+            return outline.tokens
+        # Outlines stored before token IDs were recorded are tokenized here and
+        # kept with the reference data, without writing to the database
+        return self._get_encoding().encode(outline.content)
+        
     def _build_generation_prompt(self, 
                                title: str, 
                                objectives: str, 
@@ -190,109 +515,66 @@ class OutlineGenerator:
                                reference_data: Dict[str, Any],
                                style_adherence: float) -> str:
         """Build the prompt for the GPT model"""
-        # Format the style guidelines
-        style = reference_data.get('style', {})
-        style_guidelines = []
-        
-        if style.get('uses_bullets', False):
-            style_guidelines.append("- Use bullet points (•) for subsections")
-        if style.get('uses_numbered_sections', True):
-            style_guidelines.append("- Use numbered sections (1., 2., etc.) for main segments")
-        if style.get('uses_timing', True):
-            style_guidelines.append("- Include duration in minutes for each segment in parentheses")
-        
-        cap_style = style.get('capitalization', 'title_case')
-        if cap_style == 'uppercase':
-            style_guidelines.append("- Use UPPERCASE for main section titles")
-        elif cap_style == 'title_case':
-            style_guidelines.append("- Use Title Case for main section titles")
-            
-        if style.get('uses_colons', False):
-            style_guidelines.append("- Use colons after section titles")
+        # Add pattern information for better RAG performance
+        patterns = reference_data.get('segment_patterns', {})
+        if not (style_adherence > 0.6 and patterns and
+                (patterns.get('common_durations') or patterns.get('segment_types'))):
+            patterns = None
         
-        # Format examples (limited to save tokens)
+        context = {
+            'title': title,
+            'objectives': objectives,
+            'total_duration': total_duration,
+            'segments': segments,
+            'style': reference_data.get('style', {}),
+            'style_adherence': style_adherence,
+            'patterns': patterns,
+            'examples': []
+        }
+        
+        # Fill the token budget left by the fixed parts with reference examples
         examples = reference_data.get('examples', [])
-        example_text = ""
+        bucket = 'style_only'
         
         if examples and style_adherence > 0.5:
-            # Process examples for RAG
-            processed_examples = []
+            fixed_prompt = self._prompt_templates['style_only'].render(context)
+            budget = PROMPT_TOKEN_BUDGET - len(self._get_encoding().encode(fixed_prompt))
+            example_tokens = reference_data.get('example_tokens') or [None] * len(examples)
             
             # If we have multiple examples, include relevant portions from each
             if len(examples) > 1 and style_adherence > 0.7:
-                # Use segments from different examples for better RAG performance
-                for i, example in enumerate(examples[:3]):  # Limit to first 3 examples
-                    # Extract a meaningful portion (first 1500 chars) to save tokens
-                    excerpt = example[:1500] + ("..." if len(example) > 1500 else "")
-                    processed_examples.append(f"EXAMPLE {i+1}:\n{excerpt}\n")
-                
-                example_text = "\nREFERENCE EXAMPLES:\n\n" + "\n".join(processed_examples) + "\n"
+                context['examples'] = self._pack_examples(examples[:3], example_tokens[:3], budget)
+                bucket = 'multiple_examples'
             else:
                 # Take just the first example to save tokens
-                example_text = f"\nREFERENCE EXAMPLE:\n\n{examples[0]}\n\n"
-                
-        # Add pattern information for better RAG performance
-        pattern_info = reference_data.get('segment_patterns', {})
-        if pattern_info and style_adherence > 0.6:
-            common_durations = pattern_info.get('common_durations', [])
-            segment_types = pattern_info.get('segment_types', [])
-            
-            if common_durations or segment_types:
-                pattern_text = "\nCOMMON PATTERNS:\n"
-                
-                if common_durations:
-                    pattern_text += f"- Typical durations: {', '.join(map(str, common_durations))} minutes\n"
-                
-                if segment_types:
-                    pattern_text += f"- Typical segment types: {', '.join(segment_types)}\n"
-                
-                example_text += pattern_text
-            
-        # Format segment requirements
-        segment_reqs = []
-        for seg in segments:
-            seg_title = seg.get('title', '')
-            seg_duration = seg.get('duration', 0)
-            seg_description = seg.get('description', '')
-            
-            if seg_title and seg_duration:
-                segment_reqs.append(f"- {seg_title} ({seg_duration} min): {seg_description}")
-            elif seg_title:
-                segment_reqs.append(f"- {seg_title}: {seg_description}")
+                context['examples'] = self._pack_examples(examples[:1], example_tokens[:1], budget)
+                if context['examples']:
+                    bucket = 'single_example'
         
-        segment_text = "\n".join(segment_reqs) if segment_reqs else "No specific segment requirements."
+        return self._prompt_templates[bucket].render(context)
+    
+    def _pack_examples(self, 
+                       examples: List[str], 
+                       example_tokens: List[Optional[List[int]]],
+                       budget: int) -> List[str]:
+        """Greedily include examples until the token budget is spent, truncating the last"""
+        excerpts = []
+        remaining = budget
         
-        # Build the final prompt
-        prompt = f"""
-Create a workshop programme outline with the following specifications:
-
-TITLE: {title}
-
-WORKSHOP OBJECTIVES:
-{objectives}
-
-TOTAL DURATION: {total_duration} minutes
-
-REQUIRED SEGMENTS:
-{segment_text}
-
-STYLE GUIDELINES:
-{"".join(f"{guideline}\n" for guideline in style_guidelines)}
-
-Your task is to create a complete workshop outline that follows the style and structure of the reference examples with a style adherence level of {style_adherence * 100}%. 
-The outline should incorporate all the specified objectives and segment requirements while maintaining the total duration of {total_duration} minutes.
-{example_text}
-
-IMPORTANT FORMATTING INSTRUCTIONS:
-1. Pay careful attention to the numbering and indentation patterns in the reference examples
-2. Maintain the exact same format for specifying durations (e.g., "(15 min)" or "(15 minutes)")
-3. Use consistent capitalization and punctuation as shown in the references
-4. Follow the bullet point style exactly as shown in the references
-5. Preserve any special sections like introductions, breaks, or closing segments in the same style
-
-Generate ONLY the outline itself without additional explanations or comments.
-"""
-        return prompt
+        for example, tokens in zip(examples, example_tokens):
+            if remaining <= 0:
+                break
+            if tokens is None:
+                tokens = self._get_encoding().encode(example)
+            
+            if len(tokens) <= remaining:
+                excerpts.append(example)
+                remaining -= len(tokens)
+            else:
+                excerpts.append(self._get_encoding().decode(tokens[:remaining]) + "...")
+                break
+        
+        return excerpts
     
     def regenerate_segment(self, 
                           outline_content: str, 
@@ -320,21 +602,80 @@ Generate ONLY the outline itself without additional explanations or comments.
         segments = structure.get('segments', [])
         if segment_index < 0 or segment_index >= len(segments):
             return outline_content
+        
+        request = self._build_segment_request(
+            segments[segment_index], segment_index, specifications.get('segment', {})
+        )
+
+        try:
+            # Generate the segment using GPT
+            response = openai.ChatCompletion.create(**request)
+            new_segment = response.choices[0].message.content.strip()
+            
+            # Replace the segment in the outline
+            return self._replace_segment(outline_content, segment_index, new_segment)
             
-        # Extract the segment to regenerate
-        segment = segments[segment_index]
+        except Exception as e:
+            app.logger.error(f"Error regenerating segment: {str(e)}")
+            return outline_content
+    
+    async def aregenerate_segments(self, 
+                                   outline_content: str, 
+                                   segment_specs: Dict[int, Dict[str, Any]],
+                                   reference_outlines: List[ReferenceOutline],
+                                   runner: Optional['ParallelOpenAIRunner'] = None) -> str:
+        """
+        Regenerate several segments of an outline concurrently.
+        
+        Args:
+            outline_content: The existing outline content
+            segment_specs: Updated specifications keyed by segment index
+            reference_outlines: Reference outlines for style
+            runner: Rate-limited runner to submit requests through
+            
+        Returns:
+            The updated outline with every requested segment regenerated
+        """
+        from app.outline_parser import OutlineParser
+        parser = OutlineParser()
+        structure = parser.parse_outline(outline_content)
+        segments = structure.get('segments', [])
+        
+        # Build one request per valid segment index
+        indices = sorted(i for i in segment_specs if 0 <= i < len(segments))
+        if not indices:
+            return outline_content
+        
+        runner = runner or ParallelOpenAIRunner()
+        results = await asyncio.gather(*(
+            runner.submit(self._build_segment_request(segments[i], i, segment_specs[i]))
+            for i in indices
+        ), return_exceptions=True)
+        
+        # Replace from the last segment backwards so earlier positions stay valid
+        updated_content = outline_content
+        for segment_index, result in reversed(list(zip(indices, results))):
+            if isinstance(result, Exception):
+                app.logger.error(f"Error regenerating segment {segment_index}: {str(result)}")
+                continue
+            new_segment = result.choices[0].message.content.strip()
+            updated_content = self._replace_segment(updated_content, segment_index, new_segment)
+        
+        return updated_content
+    
+    def _build_segment_request(self, 
+                               segment: Dict[str, Any], 
+                               segment_index: int,
+                               seg_specs: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the chat completion request for regenerating one segment"""
         segment_title = segment.get('title', f"Segment {segment_index+1}")
         segment_content = "\n".join(segment.get('content', []))
         
         # Get segment specifications
-        seg_specs = specifications.get('segment', {})
         new_title = seg_specs.get('title', segment_title)
         new_duration = seg_specs.get('duration', segment.get('duration', 0))
         new_description = seg_specs.get('description', '')
         
-        # Extract style information
-        reference_data = self._extract_reference_data(reference_outlines)
-        
         # Build prompt for segment regeneration
         prompt = f"""
 I have a workshop outline and need to regenerate the following segment:
@@ -349,170 +690,351 @@ NEW SPECIFICATIONS:
 
 Please regenerate this segment while maintaining the style and structure consistency with the rest of the outline. The output should only include the regenerated segment, not the entire outline.
 """
-
-        try:
-            # Generate the segment using GPT
-            response = openai.ChatCompletion.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "You are a specialized assistant that creates workshop programme outlines. You strictly adhere to the style and structure of reference outlines."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.4,
-                max_tokens=500
-            )
-            
-            new_segment = response.choices[0].message.content.strip()
-            
-            # Replace the segment in the outline
-            lines = outline_content.split('\n')
-            
-            # Find the start and end of the segment
-            start_line = -1
-            end_line = -1
-            in_segment = False
-            current_seg_idx = -1
-            
-            for i, line in enumerate(lines):
-                # Check if this is a new segment
-                segment_match = parser._patterns.get('segment_title')
-                if segment_match and re.search(segment_match, line):
-                    if in_segment:
-                        # End of previous segment
-                        end_line = i - 1
-                        if current_seg_idx == segment_index:
-                            break
-                    
-                    # Start of new segment
-                    in_segment = True
-                    current_seg_idx += 1
-                    
-                    if current_seg_idx == segment_index:
-                        start_line = i
-            
-            # If it's the last segment, end is the last line
-            if current_seg_idx == segment_index and end_line == -1:
-                end_line = len(lines) - 1
-                
-            # Replace the segment if found
-            if start_line >= 0 and end_line >= start_line:
-                new_segment_lines = new_segment.split('\n')
-                lines = lines[:start_line] + new_segment_lines + lines[end_line+1:]
-                
-            return "\n".join(lines)
-            
-        except Exception as e:
-            app.logger.error(f"Error regenerating segment: {str(e)}")
+        return {
+            "api_key": self.api_key,
+            "model": GENERATION_MODEL,
+            "messages": [
+                {"role": "system", "content": "You are a specialized assistant that creates workshop programme outlines. You strictly adhere to the style and structure of reference outlines."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.4,
+            "max_tokens": 500
+        }
+    
+    def _replace_segment(self, outline_content: str, segment_index: int, new_segment: str) -> str:
+        """Replace the segment at segment_index with new_segment"""
+        matches = list(SEGMENT_START_RE.finditer(outline_content))
+        if segment_index < 0 or segment_index >= len(matches):
             return outline_content
+        
+        # The segment runs up to the next segment heading, or the end of the outline
+        start = matches[segment_index].start()
+        end = matches[segment_index + 1].start() if segment_index + 1 < len(matches) else len(outline_content)
+        
+        # Keep the whitespace that separated the old segment from what follows
+        old_segment = outline_content[start:end]
+        trailing = old_segment[len(old_segment.rstrip()):]
+        
+        return outline_content[:start] + new_segment + trailing + outline_content[end:]
 
-"""
-Enhancements to the AI Generator to better support PDF-sourced reference outlines
-"""
-
-# Add/update these methods in the OutlineGenerator class
-
-def _process_pdf_references(self, reference_outlines):
-    """Process references that came from PDF files for better RAG performance"""
-    pdf_references = []
+class OutlineCache:
+    """
+    Cache generated outlines for generation requests.
     
-    for outline in reference_outlines:
-        # Check if this was a PDF reference
-        if hasattr(outline, 'filename') and outline.filename.endswith('.pdf'):
-            pdf_references.append(outline)
+    Exact repeats are matched by the generation key (prompt, model and
+    max_tokens). Near-duplicates are matched by cosine similarity between
+    embeddings of the specifications (title, objectives and segments, not the
+    prompt template or reference examples) above a threshold, among entries
+    with the same model, total duration and segment count.
     
-    # Extract additional context from PDF references if available
-    pdf_context = ""
-    if pdf_references:
-        pdf_context = self._extract_pdf_context(pdf_references)
+    Every entry is persisted; the most recent max_entries are kept in memory
+    for lookups. Instances are shared by request threads.
+    """
     
-    return pdf_context
-
-def _extract_pdf_context(self, pdf_references):
-    """Extract context information specific to PDF references"""
-    context_parts = []
+    def __init__(self, 
+                 api_key=None,
+                 threshold: float = 0.93, 
+                 model: str = "text-embedding-3-small",
+                 max_entries: int = OUTLINE_CACHE_SIZE):
+        self.api_key = api_key or app.config['OPENAI_API_KEY']
+        self.threshold = threshold
+        self.model = model
+        self.max_entries = max_entries
+        
+        self._lock = threading.Lock()
+        self._loaded = False
+        
+        # Entries in a ring of max_entries slots, the oldest overwritten first
+        self._next_slot = 0
+        self._slot_by_key: Dict[str, int] = {}
+        self._entries: List[Optional[Tuple[str, str]]] = [None] * max_entries  # (key, outline) per slot
+        self._matrix: Optional[np.ndarray] = None  # Normalized specification embeddings, allocated on first use
+        self._has_embedding = np.zeros(max_entries, dtype=bool)
+        self._durations = np.full(max_entries, -1, dtype=np.int64)
+        self._segment_counts = np.full(max_entries, -1, dtype=np.int64)
+        self._models = np.full(max_entries, None, dtype=object)
+        
+        # Embeddings computed on lookup, awaiting store or discard
+        self._pending: Dict[str, np.ndarray] = {}
     
-    for ref in pdf_references:
-        structure = ref.structure if ref.structure else {}
+    def lookup(self, key: str, specifications: Dict[str, Any], model: str) -> Optional[str]:
+        """
+        Find a cached outline for a generation request.
         
-        # Extract key style elements that might be harder to detect in PDFs
-        if 'format_style' in structure:
-            style = structure['format_style']
-            style_desc = []
-            
-            if style.get('uses_bullets', False):
-                style_desc.append("Uses bullet points for subsections")
-            if style.get('uses_numbered_sections', False):
-                style_desc.append("Uses numbered sections for main segments")
-            if style.get('uses_timing', False):
-                style_desc.append("Includes duration in minutes for segments")
-            if 'capitalization' in style:
-                cap_style = style['capitalization']
-                if cap_style == 'uppercase':
-                    style_desc.append("Uses UPPERCASE for section titles")
-                elif cap_style == 'title_case':
-                    style_desc.append("Uses Title Case for section titles")
+        Args:
+            key: The request's generation_key
+            specifications: User requirements the prompt was built from
+            model: The generation model
             
-            # Add to context
-            if style_desc:
-                context_parts.append(f"PDF Reference '{ref.title}' Style: " + "; ".join(style_desc))
-        
-        # Extract segment structure
-        if 'segments' in structure and structure['segments']:
-            segments = structure['segments']
-            segment_desc = []
+        Returns:
+            The cached outline, or None on a miss
+        """
+        outline, needs_embedding = self._exact_match(key)
+        if not needs_embedding:
+            return outline
+        return self._semantic_match(key, self._embed(self._specification_text(specifications)),
+                                    specifications, model)
+    
+    async def alookup(self, key: str, specifications: Dict[str, Any], model: str) -> Optional[str]:
+        """Async variant of lookup; the specifications are embedded without blocking the event loop"""
+        outline, needs_embedding = self._exact_match(key)
+        if not needs_embedding:
+            return outline
+        return self._semantic_match(key, await self._aembed(self._specification_text(specifications)),
+                                    specifications, model)
+    
+    def store(self, key: str, specifications: Dict[str, Any], model: str, outline: str):
+        """
+        Cache a generated outline for a generation request.
+        
+        Args:
+            key: The request's generation_key
+            specifications: User requirements the prompt was built from
+            model: The generation model
+            outline: The generated outline text
+        """
+        embedding, is_cached = self._take_pending(key)
+        if is_cached:
+            return
+        if embedding is None:
+            embedding = self._embed(self._specification_text(specifications))
+        self._save(key, embedding, specifications, model, outline)
+    
+    async def astore(self, key: str, specifications: Dict[str, Any], model: str, outline: str):
+        """Async variant of store; the specifications are embedded without blocking the event loop"""
+        embedding, is_cached = self._take_pending(key)
+        if is_cached:
+            return
+        if embedding is None:
+            embedding = await self._aembed(self._specification_text(specifications))
+        self._save(key, embedding, specifications, model, outline)
+    
+    def discard(self, key: str):
+        """Drop the embedding kept from a lookup whose request ended without a store"""
+        with self._lock:
+            self._pending.pop(key, None)
+    
+    def _exact_match(self, key: str) -> Tuple[Optional[str], bool]:
+        """The outline stored under key, and whether a similarity lookup is still worth embedding for"""
+        self._load()
+        with self._lock:
+            slot = self._slot_by_key.get(key)
+            if slot is not None:
+                return self._entries[slot][1], False
+            return None, bool(self._has_embedding.any())
+    
+    def _take_pending(self, key: str) -> Tuple[Optional[np.ndarray], bool]:
+        """The embedding kept from the lookup for key, and whether key is already cached"""
+        self._load()
+        with self._lock:
+            return self._pending.pop(key, None), key in self._slot_by_key
+    
+    def _semantic_match(self, 
+                        key: str, 
+                        query: Optional[np.ndarray],
+                        specifications: Dict[str, Any],
+                        model: str) -> Optional[str]:
+        """Outline of the most similar comparable entry, if above the threshold"""
+        if query is None:
+            return None
+        duration, segment_count = self._specification_shape(specifications)
+        
+        with self._lock:
+            self._pending[key] = query
             
-            for i, seg in enumerate(segments[:5]):  # Limit to first 5 segments
-                title = seg.get('title', f"Segment {i+1}")
-                duration = seg.get('duration', 0)
-                if duration > 0:
-                    segment_desc.append(f"{title} ({duration} min)")
-                else:
-                    segment_desc.append(title)
+            # Only entries generated for the same model, duration and segment count qualify
+            candidates = np.flatnonzero(self._has_embedding
+                                        & (self._durations == duration)
+                                        & (self._segment_counts == segment_count)
+                                        & (self._models == model))
+            if not len(candidates):
+                return None
             
-            if segment_desc:
-                context_parts.append(f"PDF Reference '{ref.title}' Segments: " + "; ".join(segment_desc))
+            scores = self._matrix[candidates] @ query
+            best = int(np.argmax(scores))
+            if scores[best] > self.threshold:
+                return self._entries[candidates[best]][1]
+        return None
     
-    return "\n".join(context_parts)
-
-# Update the generate_outline method to include PDF-specific context
-"""
-def generate_outline(self, 
-                    specifications: Dict[str, Any], 
-                    reference_outlines: List[ReferenceOutline],
-                    style_adherence: float = 0.8) -> str:
-    ...
+    def _specification_text(self, specifications: Dict[str, Any]) -> str:
+        """Text embedded for similarity lookups: what the user asked for"""
+        parts = [
+            f"Title: {specifications.get('title', '')}",
+            f"Objectives: {specifications.get('objectives', '')}"
+        ]
+        for segment in specifications.get('segments', []):
+            parts.append(f"Segment: {segment.get('title', '')} - {segment.get('description', '')}")
+        return "\n".join(parts)
     
-    # Extract style and structure information from references
-    reference_data = self._extract_reference_data(reference_outlines)
+    def _specification_shape(self, specifications: Dict[str, Any]) -> Tuple[int, int]:
+        """Total duration and segment count, which similarity matches must share"""
+        return specifications.get('total_duration', 120), len(specifications.get('segments', []))
     
-    # Extract additional context from PDF references if any
-    pdf_context = self._process_pdf_references(reference_outlines)
+    def _save(self, 
+              key: str, 
+              embedding: Optional[np.ndarray], 
+              specifications: Dict[str, Any],
+              model: str,
+              outline: str):
+        """Persist an entry and add it to the in-memory index"""
+        duration, segment_count = self._specification_shape(specifications)
+        try:
+            # A session of its own, so the request's pending changes are
+            # neither committed nor rolled back with the cache entry
+            with Session(db.engine) as session:
+                session.add(CachedOutline(prompt_hash=key, embedding=embedding, content=outline, model=model,
+                                          total_duration=duration, segment_count=segment_count))
+                session.commit()
+        except Exception as e:
+            app.logger.error(f"Error caching outline: {str(e)}")
+            return
+        
+        with self._lock:
+            self._add_entry(key, embedding, duration, segment_count, model, outline)
     
-    # Build the prompt for the GPT model
-    prompt = self._build_generation_prompt(
-        title, objectives, total_duration, segments, reference_data, style_adherence, pdf_context
-    )
+    def _load(self):
+        """Load the most recent cached entries from the database on first use"""
+        if self._loaded:
+            return
+        
+        rows = (db.session.query(CachedOutline.prompt_hash, CachedOutline.embedding,
+                                 CachedOutline.total_duration, CachedOutline.segment_count,
+                                 CachedOutline.model, CachedOutline.content)
+                .order_by(CachedOutline.id.desc())
+                .limit(self.max_entries)
+                .all())
+        
+        with self._lock:
+            if self._loaded:
+                return
+            for row in reversed(rows):
+                self._add_entry(*row)
+            self._loaded = True
+    
+    def _add_entry(self, 
+                   key: str, 
+                   embedding: Optional[np.ndarray], 
+                   duration: Optional[int],
+                   segment_count: Optional[int],
+                   model: Optional[str],
+                   outline: str):
+        """Write an entry into the next slot, evicting the oldest entry; called with the lock held"""
+        if key in self._slot_by_key:
+            return
+        
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.max_entries
+        evicted = self._entries[slot]
+        if evicted is not None:
+            del self._slot_by_key[evicted[0]]
+        
+        self._entries[slot] = (key, outline)
+        self._slot_by_key[key] = slot
+        
+        # Entries cached before these were recorded (NULL) never match by similarity
+        self._durations[slot] = duration if duration is not None else -1
+        self._segment_counts[slot] = segment_count if segment_count is not None else -1
+        self._models[slot] = model
+        
+        if embedding is not None and self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, len(embedding)), dtype=np.float32)
+        self._has_embedding[slot] = embedding is not None and len(embedding) == self._matrix.shape[1]
+        if self._has_embedding[slot]:
+            self._matrix[slot] = embedding
+    
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """Generate a normalized embedding for a specification text"""
+        try:
+            response = openai.Embedding.create(api_key=self.api_key, model=self.model, input=text)
+            return self._normalized_embedding(response)
+        except Exception as e:
+            app.logger.error(f"Error embedding specifications for cache: {str(e)}")
+            return None
+    
+    async def _aembed(self, text: str) -> Optional[np.ndarray]:
+        """Async variant of _embed"""
+        try:
+            response = await openai.Embedding.acreate(api_key=self.api_key, model=self.model, input=text)
+            return self._normalized_embedding(response)
+        except Exception as e:
+            app.logger.error(f"Error embedding specifications for cache: {str(e)}")
+            return None
+    
+    def _normalized_embedding(self, response) -> Optional[np.ndarray]:
+        """The embedding of an Embedding response, scaled to unit length"""
+        embedding = np.array(response['data'][0]['embedding'], dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else None
     
-    ...
-"""
 
-# Update the _build_generation_prompt method to include PDF context
-"""
-def _build_generation_prompt(self, 
-                           title: str, 
-                           objectives: str, 
-                           total_duration: int,
-                           segments: List[Dict[str, Any]],
-                           reference_data: Dict[str, Any],
-                           style_adherence: float,
-                           pdf_context: str = "") -> str:
-    ...
-    
-    # Add PDF-specific context if available
-    if pdf_context:
-        prompt += f"\nADDITIONAL PDF REFERENCE CONTEXT:\n{pdf_context}\n"
-    
-    prompt += "\nIMPORTANT FORMATTING INSTRUCTIONS:\n..."
-    
-    return prompt
-"""
+
+class ParallelOpenAIRunner:
+    """
+    Submit chat completion requests concurrently while staying under the
+    account's requests-per-minute and tokens-per-minute limits.
+    
+    Create one runner per event loop and reuse it for every request in that
+    loop; too many in-flight connections trigger APIConnectionError.
+    """
+    
+    def __init__(self, 
+                 max_in_flight: int = 16,
+                 max_requests_per_minute: float = 500,
+                 max_tokens_per_minute: float = 80000,
+                 max_attempts: int = 5):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.max_attempts = max_attempts
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        
+        # Leaky-bucket capacity, refilled continuously up to the per-minute cap
+        self.requests_last_minute = 0.0
+        self.tokens_used_last_minute = 0.0
+        self._last_update = time.monotonic()
+    
+    async def submit(self, request: Dict[str, Any]):
+        """
+        Send one chat completion request, waiting for rate-limit capacity and
+        retrying with exponential backoff on RateLimitError.
+        
+        Args:
+            request: Keyword arguments for openai.ChatCompletion.acreate
+            
+        Returns:
+            The chat completion response
+        """
+        token_estimate = self._estimate_tokens(request)
+        
+        async with self._semaphore:
+            for attempt in range(self.max_attempts):
+                await self._wait_for_capacity(token_estimate)
+                try:
+                    return await openai.ChatCompletion.acreate(**request)
+                except openai.error.RateLimitError:
+                    if attempt == self.max_attempts - 1:
+                        raise
+                    await asyncio.sleep(min(2 ** attempt, 60))
+    
+    async def _wait_for_capacity(self, token_estimate: int):
+        """Block until the bucket has room for one more request"""
+        while True:
+            self._leak()
+            if (self.requests_last_minute + 1 <= self.max_requests_per_minute and
+                    self.tokens_used_last_minute + token_estimate <= self.max_tokens_per_minute):
+                self.requests_last_minute += 1
+                self.tokens_used_last_minute += token_estimate
+                return
+            await asyncio.sleep(0.05)
+    
+    def _leak(self):
+        """Release the capacity consumed more than a minute ago"""
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+        self.requests_last_minute = max(0.0, self.requests_last_minute - self.max_requests_per_minute * elapsed / 60)
+        self.tokens_used_last_minute = max(0.0, self.tokens_used_last_minute - self.max_tokens_per_minute * elapsed / 60)
+    
+    def _estimate_tokens(self, request: Dict[str, Any]) -> int:
+        """Rough token count for a request (~4 characters per token plus completion)"""
+        prompt_chars = sum(len(message.get('content', '')) for message in request.get('messages', []))
+        return prompt_chars // 4 + request.get('max_tokens', 0)
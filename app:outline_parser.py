@@ -5,13 +5,54 @@ Extracts structured data from reference outlines and generates embeddings
 for similarity search.
 """
 
+import os
 import re
-import json
+import orjson
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from itertools import islice
+from concurrent.futures import Future
 import numpy as np
-from typing import Dict, List, Any, Tuple
+import faiss
+from typing import Dict, List, Any, Optional, Tuple
 import openai
 
 from app import app
+from app.models import fetch_reference_version
+from app._patterns import SEGMENT_TITLE_RE, DURATION_RE, SUBSECTION_RE, BREAK_RE, NUMBERED_SECTION_RE
+
+# Embedding requests. The API accepts up to 2048 inputs per request; chunks of
+# larger batches are sent concurrently, a few at a time.
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_DIMENSIONS = 1536
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_CONCURRENCY = 5
+EMBEDDING_MAX_ATTEMPTS = 5
+
+# Single embedding calls made within this many seconds share one request
+EMBEDDING_BATCH_WINDOW = 0.01
+
+# Number of embeddings kept in memory, keyed by a hash of the embedded text
+EMBEDDING_CACHE_SIZE = 4096
+
+# Reference index files: normalized rows quantized to int8 and their reference IDs
+EMBEDDING_INDEX_FILE = 'embeddings.i8'
+
+# Normalized components lie in [-1, 1] and are stored as round(x * 127)
+EMBEDDING_QUANTIZATION_SCALE = 127
+EMBEDDING_INDEX_IDS_FILE = 'ids.npy'
+
+# updated_at of each reference when its row was written, so an index whose
+# references were edited since is rebuilt rather than adopted
+EMBEDDING_INDEX_UPDATED_AT_FILE = 'updated_at.npy'
+
+# From this many references, similarity search goes through an HNSW graph
+# (approximate, sub-linear) instead of scanning every row of the matrix
+HNSW_MIN_REFERENCES = 5000
+HNSW_NEIGHBORS = 32
+HNSW_EF_SEARCH = 64
 
 class OutlineParser:
     """
@@ -20,10 +61,10 @@ class OutlineParser:
     
     def __init__(self):
         self.patterns = {
-            'segment_title': r'^\s*\d+\.\s+(.*?)(?:\s+\(\d+\s*(?:min|minutes)\)|\s*$)',
-            'duration': r'\((\d+)\s*(?:min|minutes)\)',
-            'subsection': r'^\s*•\s+(.*?)$',
-            'break': r'(?i)break|pause|rest'
+            'segment_title': SEGMENT_TITLE_RE,
+            'duration': DURATION_RE,
+            'subsection': SUBSECTION_RE,
+            'break': BREAK_RE
         }
     
     def parse_outline(self, content: str) -> Dict[str, Any]:
@@ -37,13 +78,14 @@ class OutlineParser:
             A dictionary containing the parsed structure
         """
         lines = content.split('\n')
+        segments = self._extract_segments(lines)
         structure = {
             'title': self._extract_title(lines),
-            'segments': self._extract_segments(lines),
+            'segments': segments,
             'total_duration': 0,
             'has_breaks': False,
             'segment_count': 0,
-            'format_style': self._detect_format_style(content)
+            'format_style': self._detect_format_style(content, [seg['title'] for seg in segments])
         }
         
         # Calculate aggregate data
@@ -55,8 +97,8 @@ class OutlineParser:
     
     def _extract_title(self, lines: List[str]) -> str:
         """Extract the title from the first few lines of the outline"""
-        for line in lines[:5]:  # Check first 5 lines for title
-            if line and not line.startswith(('#', '•', '-', '*')):
+        for line in islice(lines, 5):  # Check first 5 lines for title
+            if line and line[0] not in '#•-*':
                 return line.strip()
         return "Untitled Workshop"
     
@@ -70,8 +112,11 @@ class OutlineParser:
             if not line:
                 continue
                 
-            # Check if this is a new segment
-            segment_match = re.search(self.patterns['segment_title'], line)
+            # Classify the line by its first character; only numbered lines
+            # can start a segment and only bullet lines can be subsections
+            first = line[0]
+            segment_match = self.patterns['segment_title'].match(line) if first.isdigit() else None
+            
             if segment_match:
                 # Save previous segment if it exists
                 if current_segment:
@@ -79,21 +124,20 @@ class OutlineParser:
                 
                 # Start new segment
                 title = segment_match.group(1).strip()
-                duration_match = re.search(self.patterns['duration'], line)
+                duration_match = self.patterns['duration'].search(line)
                 duration = int(duration_match.group(1)) if duration_match else 0
                 
                 current_segment = {
                     'title': title,
                     'duration': duration,
                     'content': [line],
-                    'is_break': bool(re.search(self.patterns['break'], title, re.IGNORECASE)),
+                    'is_break': bool(self.patterns['break'].search(title)),
                     'subsections': []
                 }
             
-            # Check if this is a subsection
-            elif current_segment and re.search(self.patterns['subsection'], line):
-                subsection = re.search(self.patterns['subsection'], line).group(1).strip()
-                current_segment['subsections'].append(subsection)
+            # Check if this is a subsection ("•" followed by whitespace)
+            elif current_segment and first == '•' and line[1:2].isspace():
+                current_segment['subsections'].append(line[1:].strip())
                 current_segment['content'].append(line)
             
             # Otherwise, add to current segment content
@@ -106,23 +150,23 @@ class OutlineParser:
             
         return segments
     
-    def _detect_format_style(self, content: str) -> Dict[str, Any]:
-        """Detect formatting style from the outline"""
+    def _detect_format_style(self, content: str, segment_titles: List[str]) -> Dict[str, Any]:
+        """Detect formatting style from the outline and its parsed segment titles"""
+        # 'in' and re.search stop at the first occurrence, so these are cheap
         style = {
             'uses_bullets': '•' in content,
-            'uses_numbered_sections': bool(re.search(r'^\s*\d+\.', content, re.MULTILINE)),
-            'uses_timing': bool(re.search(self.patterns['duration'], content)),
-            'capitalization': self._detect_capitalization(content),
+            'uses_numbered_sections': bool(NUMBERED_SECTION_RE.search(content)),
+            'uses_timing': bool(self.patterns['duration'].search(content)),
+            'capitalization': self._detect_capitalization(segment_titles),
             'uses_colons': ':' in content
         }
         return style
     
-    def _detect_capitalization(self, content: str) -> str:
+    def _detect_capitalization(self, segment_titles: List[str]) -> str:
         """Detect capitalization style in section headers"""
         title_case_count = 0
         uppercase_count = 0
         
-        segment_titles = re.findall(self.patterns['segment_title'], content, re.MULTILINE)
         if not segment_titles:
             return "unknown"
             
@@ -145,13 +189,40 @@ class EmbeddingGenerator:
     Generate and manage embeddings for reference outlines.
     """
     
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, index_folder=None):
         self.api_key = api_key or app.config['OPENAI_API_KEY']
+        self.index_folder = index_folder or app.config.get('EMBEDDING_INDEX_FOLDER')
+        
+        # L2-normalized reference embeddings quantized to int8, one row per reference ID,
+        # memory-mapped from the index files when an index folder is set
+        self._ref_matrix = None
+        self._ref_ids = None
+        self._ref_updated_at = None  # datetime64 per row, for index files only
+        
+        # fetch_reference_version() when the matrix was last synced; it is
+        # rebuilt once the stored references move past it, whichever process
+        # wrote them
+        self._ref_version = None
+        self._hnsw_index = None
+        self._index_lock = threading.Lock()
+        self._load_reference_index()
+        
+        # Embeddings of recently embedded texts, least recently used first
+        self._embedding_cache: OrderedDict = OrderedDict()
+        self._embedding_cache_lock = threading.Lock()
+        
+        # Single embedding calls waiting for the batch window to close
+        self._pending: List[Tuple[str, Future]] = []
+        self._pending_lock = threading.Lock()
+        self._flush_timer = None
         
     def generate_embedding(self, content: str, structure: Dict[str, Any]) -> np.ndarray:
         """
         Generate an embedding vector for a reference outline.
         
+        Calls arriving together from different threads are sent as one batched
+        request.
+        
         Args:
             content: The raw outline content
             structure: The parsed structure of the outline
@@ -160,23 +231,151 @@ class EmbeddingGenerator:
             A numpy array containing the embedding vector
         """
         # Prepare a concise representation of the outline for embedding
-        embedding_text = self._prepare_embedding_text(content, structure)
+        return self._embed_text(self._prepare_embedding_text(content, structure))
+    
+    def generate_query_embedding(self, specifications: Dict[str, Any]) -> np.ndarray:
+        """
+        Generate an embedding vector for new outline specifications, to
+        search the reference outlines with.
+        
+        Args:
+            specifications: Specifications dictionary for the new outline
+            
+        Returns:
+            A numpy array containing the embedding vector
+        """
+        return self._embed_text(self._prepare_query_text(specifications))
+    
+    def _embed_text(self, embedding_text: str) -> np.ndarray:
+        """Embed one prepared text, batched with concurrent calls and cached by content"""
+        # Re-uploads and edits that keep the structure produce the same text
+        cached_embedding = self._cached_embedding(self._embedding_key(embedding_text))
+        if cached_embedding is not None:
+            return cached_embedding
+        
+        future = Future()
+        with self._pending_lock:
+            self._pending.append((embedding_text, future))
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(EMBEDDING_BATCH_WINDOW, self._flush_pending)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
         
         try:
-            # Generate embedding using OpenAI's API
-            response = openai.Embedding.create(
-                model="text-embedding-ada-002",
-                input=embedding_text
-            )
-            embedding = np.array(response['data'][0]['embedding'], dtype=np.float32)
-            return embedding
+            return future.result()
             
         except Exception as e:
             app.logger.error(f"Error generating embedding: {str(e)}")
-            # Fallback: Create a simple TF-IDF style embedding (in a real app, we'd use a better fallback)
-            words = set(re.findall(r'\w+', content.lower()))
             # Return a simple dummy embedding (zeros) in case of error
-            return np.zeros(1536, dtype=np.float32)  # Ada embeddings are 1536 dimensions
+            return np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    
+    def _flush_pending(self):
+        """Embed every pending single call in one batch and resolve their futures"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+            self._flush_timer = None
+        
+        try:
+            embeddings = asyncio.run(self.generate_embeddings_batch([text for text, _ in pending]))
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        
+        for (_, future), embedding in zip(pending, embeddings):
+            future.set_result(embedding)
+    
+    async def agenerate_outline_embeddings(self, outlines: List[Tuple[str, Dict[str, Any]]]) -> List[np.ndarray]:
+        """
+        Generate embedding vectors for several reference outlines in one batch.
+        
+        Args:
+            outlines: List of (content, structure) tuples
+            
+        Returns:
+            Embedding vectors, in the same order as outlines
+        """
+        texts = [self._prepare_embedding_text(content, structure) for content, structure in outlines]
+        
+        try:
+            return await self.generate_embeddings_batch(texts)
+            
+        except Exception as e:
+            app.logger.error(f"Error generating embeddings: {str(e)}")
+            return [np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32) for _ in texts]
+    
+    async def generate_embeddings_batch(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        Generate embeddings for many texts with as few requests as possible.
+        
+        Args:
+            texts: Texts to embed
+            
+        Returns:
+            Embedding vectors, in the same order as texts
+        """
+        keys = [self._embedding_key(text) for text in texts]
+        embeddings = [self._cached_embedding(key) for key in keys]
+        
+        # Only texts without a cached embedding are sent, each distinct text once
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        chunks = [missing[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(missing), EMBEDDING_BATCH_SIZE)]
+        results = await asyncio.gather(*(self._embed_batch(chunk, semaphore) for chunk in chunks))
+        
+        embedded = dict(zip(missing, (embedding for chunk_embeddings in results for embedding in chunk_embeddings)))
+        for text, embedding in embedded.items():
+            self._cache_embedding(self._embedding_key(text), embedding)
+        
+        return [embedding if embedding is not None else embedded[text]
+                for text, embedding in zip(texts, embeddings)]
+    
+    async def _embed_batch(self, texts: List[str], semaphore: asyncio.Semaphore) -> List[np.ndarray]:
+        """Embed one chunk of texts in a single request, backing off on RateLimitError"""
+        async with semaphore:
+            for attempt in range(EMBEDDING_MAX_ATTEMPTS):
+                try:
+                    response = await openai.Embedding.acreate(
+                        api_key=self.api_key,
+                        model=EMBEDDING_MODEL,
+                        input=texts
+                    )
+                    break
+                except openai.error.RateLimitError as e:
+                    if attempt == EMBEDDING_MAX_ATTEMPTS - 1:
+                        raise
+                    await asyncio.sleep(self._retry_delay(e, attempt))
+        
+        # Each result carries the index of its input
+        data = sorted(response['data'], key=lambda item: item['index'])
+        return [np.array(item['embedding'], dtype=np.float32) for item in data]
+    
+    def _embedding_key(self, text: str) -> str:
+        """Content address of an embedding text"""
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+    
+    def _cached_embedding(self, key: str):
+        """Cached embedding for a key, or None"""
+        with self._embedding_cache_lock:
+            embedding = self._embedding_cache.get(key)
+            if embedding is not None:
+                self._embedding_cache.move_to_end(key)
+            return embedding
+    
+    def _cache_embedding(self, key: str, embedding: np.ndarray):
+        """Store an embedding, evicting the least recently used beyond EMBEDDING_CACHE_SIZE"""
+        with self._embedding_cache_lock:
+            self._embedding_cache[key] = embedding
+            if len(self._embedding_cache) > EMBEDDING_CACHE_SIZE:
+                self._embedding_cache.popitem(last=False)
+    
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """Seconds to wait before retrying: the server's retry-after, else exponential backoff"""
+        retry_after = (getattr(error, 'headers', None) or {}).get('retry-after')
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return min(2 ** attempt, 60)
     
     def _prepare_embedding_text(self, content: str, structure: Dict[str, Any]) -> str:
         """Prepare a concise text representation for embedding"""
@@ -188,38 +387,200 @@ class EmbeddingGenerator:
         # Create a descriptive representation
         parts = [
             f"Workshop title: {structure.get('title', 'Untitled')}",
-            f"Format style: {json.dumps(format_style)}",
+            f"Format style: {orjson.dumps(format_style).decode()}",
             f"Segments: {' | '.join(segment_titles)}",
             f"Total duration: {structure.get('total_duration', 0)} minutes",
             f"Segment count: {structure.get('segment_count', 0)}"
         ]
         
         return "\n".join(parts)
+    
+    def _prepare_query_text(self, specifications: Dict[str, Any]) -> str:
+        """Prepare specifications for embedding, in the shape of a reference's text"""
+        segments = specifications.get('segments', [])
         
-    def find_similar_outlines(self, embedding: np.ndarray, reference_embeddings: List[Tuple[int, np.ndarray]], top_n=3) -> List[int]:
+        # Objectives carry most of what the user asks for. There is no format
+        # style line: a request has none, and an empty one would pull the
+        # search towards references stored without a style.
+        parts = [f"Workshop title: {specifications.get('title') or 'Untitled'}"]
+        if specifications.get('objectives'):
+            parts.append(f"Objectives: {specifications['objectives']}")
+        parts += [
+            f"Segments: {' | '.join(seg.get('title', '') for seg in segments)}",
+            f"Total duration: {specifications.get('total_duration', 0)} minutes",
+            f"Segment count: {len(segments)}"
+        ]
+        
+        return "\n".join(parts)
+        
+    @property
+    def needs_reference_embeddings(self) -> bool:
+        """Whether the reference matrix is missing or older than the stored embeddings"""
+        return self._ref_version != fetch_reference_version()
+    
+    @property
+    def has_reference_embeddings(self) -> bool:
+        """Whether the reference matrix holds at least one reference"""
+        return self._ref_ids is not None and len(self._ref_ids) > 0
+    
+    def adopt_reference_index(self, references: List[Tuple[int, Any]]) -> bool:
+        """
+        Use the index loaded from disk without rebuilding it, if it holds
+        exactly these references, none of them updated since it was written.
+        Only an index that has not been synced in this process can be
+        adopted; later changes always rebuild.
+        
+        Args:
+            references: (id, updated_at) of every reference outline with an embedding
+            
+        Returns:
+            Whether the loaded index was adopted
+        """
+        if self._ref_version is not None or self._ref_ids is None or self._ref_updated_at is None:
+            return False
+        
+        ids = np.array([ref[0] for ref in references], dtype=np.int64)
+        updated_at = np.array([ref[1] for ref in references], dtype='datetime64[us]')
+        order, stored_order = np.argsort(ids), np.argsort(self._ref_ids)
+        
+        # Unknown timestamps (NaT) never compare equal, so they always rebuild
+        if not (np.array_equal(ids[order], self._ref_ids[stored_order])
+                and np.array_equal(updated_at[order], self._ref_updated_at[stored_order])):
+            return False
+        self._ref_version = fetch_reference_version()
+        return True
+    
+    def set_reference_embeddings(self, 
+                                 reference_embeddings: List[Tuple[int, np.ndarray]],
+                                 updated_at: Optional[List[Any]] = None):
+        """
+        Build the normalized reference matrix searched by find_similar_outlines.
+        
+        Args:
+            reference_embeddings: List of (id, embedding) tuples
+            updated_at: updated_at of each reference, recorded with the index
+                files so a later process can adopt them; without it they never are
+        """
+        version = fetch_reference_version()
+        ids = np.array([ref[0] for ref in reference_embeddings], dtype=np.int64)
+        if updated_at is None:
+            updated_at = [None] * len(ids)
+        updated_at = np.array(updated_at, dtype='datetime64[us]')
+        if not reference_embeddings:
+            matrix = np.empty((0, EMBEDDING_DIMENSIONS), dtype=np.int8)
+        else:
+            matrix = np.vstack([ref[1] for ref in reference_embeddings]).astype(np.float32, order='C')
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1  # Zero fallback embeddings stay zero
+            matrix = self._quantize(matrix / norms)
+        
+        with self._index_lock:
+            if self.index_folder and len(ids):
+                self._write_reference_index(ids, updated_at, matrix)
+                self._load_reference_index()
+            else:
+                self._ref_ids, self._ref_matrix = ids, matrix
+                self._hnsw_index = None
+            self._ref_version = version
+    
+    def _quantize(self, normalized: np.ndarray) -> np.ndarray:
+        """Quantize normalized embedding components to int8"""
+        return np.round(normalized * EMBEDDING_QUANTIZATION_SCALE).astype(np.int8)
+    
+    def _write_reference_index(self, ids: np.ndarray, updated_at: np.ndarray, matrix: np.ndarray):
+        """Replace the index files, each written aside and renamed into place"""
+        matrix_path = os.path.join(self.index_folder, EMBEDDING_INDEX_FILE)
+        ids_path = os.path.join(self.index_folder, EMBEDDING_INDEX_IDS_FILE)
+        updated_at_path = os.path.join(self.index_folder, EMBEDDING_INDEX_UPDATED_AT_FILE)
+        
+        matrix.tofile(matrix_path + '.tmp')
+        with open(ids_path + '.tmp', 'wb') as ids_file:
+            np.save(ids_file, ids)
+        with open(updated_at_path + '.tmp', 'wb') as updated_at_file:
+            np.save(updated_at_file, updated_at)
+        os.replace(matrix_path + '.tmp', matrix_path)
+        os.replace(ids_path + '.tmp', ids_path)
+        os.replace(updated_at_path + '.tmp', updated_at_path)
+    
+    def _load_reference_index(self):
+        """Memory-map the index files, ignoring them if missing or inconsistent"""
+        if not self.index_folder:
+            return
+        matrix_path = os.path.join(self.index_folder, EMBEDDING_INDEX_FILE)
+        ids_path = os.path.join(self.index_folder, EMBEDDING_INDEX_IDS_FILE)
+        updated_at_path = os.path.join(self.index_folder, EMBEDDING_INDEX_UPDATED_AT_FILE)
+        
+        try:
+            ids = np.load(ids_path)
+            matrix_bytes = os.path.getsize(matrix_path)
+        except (OSError, ValueError):
+            return
+        if not len(ids) or matrix_bytes != len(ids) * EMBEDDING_DIMENSIONS:
+            return
+        
+        # Indexes written without timestamps (or torn mid-write) load, but are never adopted
+        try:
+            updated_at = np.load(updated_at_path)
+        except (OSError, ValueError):
+            updated_at = None
+        if updated_at is not None and len(updated_at) != len(ids):
+            updated_at = None
+        
+        self._ref_matrix = np.memmap(matrix_path, dtype=np.int8, mode='r',
+                                     shape=(len(ids), EMBEDDING_DIMENSIONS))
+        self._ref_ids = ids
+        self._ref_updated_at = updated_at
+        self._hnsw_index = None
+    
+    def _get_hnsw_index(self):
+        """Build the HNSW graph over the reference matrix on first use"""
+        with self._index_lock:
+            if self._hnsw_index is None:
+                index = faiss.IndexHNSWFlat(EMBEDDING_DIMENSIONS, HNSW_NEIGHBORS, faiss.METRIC_INNER_PRODUCT)
+                index.hnsw.efSearch = HNSW_EF_SEARCH
+                index.add(np.asarray(self._ref_matrix, dtype=np.float32) / EMBEDDING_QUANTIZATION_SCALE)
+                self._hnsw_index = index
+            return self._hnsw_index
+    
+    def find_similar_outlines(self, embedding: np.ndarray, reference_embeddings: List[Tuple[int, np.ndarray]] = None, top_n=3) -> List[int]:
         """
         Find the most similar reference outlines based on embedding similarity.
         
         Args:
             embedding: The query embedding
-            reference_embeddings: List of (id, embedding) tuples
+            reference_embeddings: List of (id, embedding) tuples, or None to search
+                the matrix from the last set_reference_embeddings call
             top_n: Number of similar outlines to return
             
         Returns:
             List of reference outline IDs sorted by similarity
         """
-        if not reference_embeddings:
+        if reference_embeddings is not None:
+            self.set_reference_embeddings(reference_embeddings)
+        if not self.has_reference_embeddings or top_n <= 0:
             return []
-            
-        # Extract IDs and embeddings
-        ids = [ref[0] for ref in reference_embeddings]
-        embeddings = np.vstack([ref[1] for ref in reference_embeddings])
         
-        # Calculate cosine similarity
-        similarities = cosine_similarity([embedding], embeddings)[0]
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        
+        # Large corpora: approximate inner-product search over the HNSW graph
+        if len(self._ref_ids) >= HNSW_MIN_REFERENCES:
+            _, neighbors = self._get_hnsw_index().search(query.reshape(1, -1), top_n)
+            neighbors = neighbors[0]
+            return self._ref_ids[neighbors[neighbors >= 0]].tolist()
+        
+        # Cosine similarity against pre-normalized rows is a single dot product,
+        # done on the int8 values (accumulated in int32) since only the ranking
+        # is needed
+        query = self._quantize(query)
+        similarities = np.einsum('ij,j->i', self._ref_matrix, query, dtype=np.int32)
         
-        # Get indices of top_n most similar
-        top_indices = np.argsort(similarities)[-top_n:][::-1]
+        # Get indices of top_n most similar: partition in O(N), then sort only those
+        top_n = min(top_n, len(similarities))
+        top_indices = np.argpartition(similarities, -top_n)[-top_n:]
+        top_indices = top_indices[np.argsort(-similarities[top_indices])]
         
         # Return reference IDs
-        return [ids[i] for i in top_indices]
+        return self._ref_ids[top_indices].tolist()
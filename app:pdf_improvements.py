@@ -6,12 +6,41 @@ Additional utilities to improve RAG with PDF documents
 
 import re
 import io
-import PyPDF2
-from typing import Dict, List, Any, Optional, Tuple
+import pypdfium2 as pdfium
+import ahocorasick
+from typing import Dict, List, Any, Optional, Tuple, Iterator
+
+# Page clean-up in one pass. A bullet absorbs the whitespace after it together
+# with whatever follows (a section number, a duration or any one character),
+# so fixes that touch the same text combine as if applied one after another.
+_PAGE_FIX_RE = re.compile(r"""
+    (?P<bullet>•)(?:\s*(?:
+        (?P<bullet_number>\d+)\.\s*(?P<bullet_initial>[A-Z])
+      | \((?P<bullet_minutes>\d+)\s*(?:min|minutes|minute)\)
+      | (?P<bullet_next>[^\n])
+    ))?
+  | (?P<number>\d+)\.\s*(?P<initial>[A-Z])
+  | \((?P<minutes>\d+)\s*(?:min|minutes|minute)\)
+""", re.VERBOSE)
+
+# Full content clean-up
+_SECTION_BREAK_RE = re.compile(r'([^\d])(\.|\))\s*([A-Z])')
+_SECTION_SPACING_RE = re.compile(r'(\d+\.\s+[^\n]+)(\d+\.)')
+_NUMBER_WORD_RE = re.compile(r'([Oo]ne|[Tt]wo|[Tt]hree|[Ff]our|[Ff]ive)\s+(\w+)')
+
+# Outline structure
+_NON_TITLE_RE = re.compile(r'^\d+\.|^•|^-')
+_SEGMENT_RE = re.compile(r'^\s*(\d+)\.\s+(.*?)(?:\s*\((\d+)\s*(?:min|minutes|minute)\))?[ \t]*$', re.MULTILINE)
+_BULLET_RE = re.compile(r'^\s*[•\-]\s+(.*?)$', re.MULTILINE)
+_TIMING_RE = re.compile(r'\(\d+\s*(?:min|minutes|minute)\)')
+
+# Embedding chunks
+_CHUNK_SEGMENT_RE = re.compile(r'(\d+\.\s+.*?)(?=\d+\.\s+|$)', re.DOTALL)
+_PARAGRAPH_BREAK_RE = re.compile(r'\n\s*\n')
 
 def enhance_pdf_extraction(pdf_path: str) -> str:
     """
-    Enhanced PDF extraction that preserves structure better than PyPDF2 alone
+    Enhanced PDF extraction that preserves structure better than plain text extraction
     
     Args:
         pdf_path: Path to the PDF file
@@ -19,54 +48,86 @@ def enhance_pdf_extraction(pdf_path: str) -> str:
     Returns:
         Extracted and processed text content
     """
-    with open(pdf_path, 'rb') as file:
-        reader = PyPDF2.PdfReader(file)
-        text_content = []
+    # Write pages into one buffer as they are produced instead of keeping a
+    # list of pages alongside the joined copy
+    buffer = io.StringIO()
+    for page_num, processed_text in enumerate(enhance_pdf_extraction_iter(pdf_path)):
+        if page_num:
+            buffer.write("\n\n")
+        buffer.write(processed_text)
+    
+    # Further process the full content for structure
+    return _post_process_content(buffer.getvalue())
+
+def enhance_pdf_extraction_iter(pdf_path: str) -> Iterator[str]:
+    """
+    Extract a PDF page by page, for callers that can work on one page at a time
+    
+    Args:
+        pdf_path: Path to the PDF file
         
-        for page_num in range(len(reader.pages)):
-            page = reader.pages[page_num]
-            # Extract raw text
-            text = page.extract_text()
+    Yields:
+        Processed text of each page, before full-content post-processing
+    """
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for page_num, page in enumerate(pdf):
+            # Extract raw text; PDFium keeps the page's line breaks (as CRLF)
+            text = page.get_textpage().get_text_range().replace('\r\n', '\n')
             
             # Process text to better identify structure
-            processed_text = _process_pdf_page(text, page_num)
-            text_content.append(processed_text)
-    
-    # Join all pages and further process for structure
-    full_content = "\n\n".join(text_content)
-    return _post_process_content(full_content)
+            yield _process_pdf_page(text, page_num)
+    finally:
+        pdf.close()
 
 def _process_pdf_page(text: str, page_num: int) -> str:
     """Process a single PDF page to preserve structure"""
+    return _PAGE_FIX_RE.sub(_fix_page_match, text)
+
+def _fix_page_match(match: re.Match) -> str:
+    """Replacement for one _PAGE_FIX_RE match"""
+    if match.group('bullet'):
+        # Fix bullet points that might be merged onto the previous line. In a
+        # run of adjacent bullets only every other one is moved, as with the
+        # pairwise substitution this replaces.
+        text, start = match.string, match.start()
+        run_start = start
+        while run_start > 0 and text[run_start - 1] == '•':
+            run_start -= 1
+        follows_text = run_start > 0 and text[run_start - 1] != '\n'
+        prefix = '\n' if (start - run_start + follows_text) % 2 else ''
+        
+        # Add spacing after bullet points for readability
+        if match.group('bullet_number'):
+            return f"{prefix}• {match.group('bullet_number')}. {match.group('bullet_initial')}"
+        if match.group('bullet_minutes'):
+            return f"{prefix}• ({match.group('bullet_minutes')} min)"
+        if match.group('bullet_next') is not None:
+            return f"{prefix}• {match.group('bullet_next')}"
+        return f"{prefix}•"
     
     # Ensure line breaks at section numbers (common in outlines)
-    text = re.sub(r'(\d+)\.\s*([A-Z])', r'\n\1. \2', text)
-    
-    # Fix bullet points that might be merged
-    text = re.sub(r'([^\n])•', r'\1\n•', text)
+    if match.group('number'):
+        return f"\n{match.group('number')}. {match.group('initial')}"
     
     # Fix durations in parentheses
-    text = re.sub(r'\((\d+)\s*(min|minutes|minute)\)', r'(\1 min)', text)
-    
-    # Add spacing after bullet points for readability
-    text = re.sub(r'•\s*([^\n])', r'• \1', text)
-    
-    return text
+    return f"({match.group('minutes')} min)"
 
 def _post_process_content(content: str) -> str:
     """Final processing of the full content"""
     
-    # Remove excessive newlines
-    content = re.sub(r'\n{3,}', '\n\n', content)
+    # Remove excessive newlines; each pass shortens every run of three or more
+    while '\n\n\n' in content:
+        content = content.replace('\n\n\n', '\n\n')
     
     # Fix potential issues with section numbering
-    content = re.sub(r'([^\d])(\.|\))\s*([A-Z])', r'\1\2\n\3', content)
+    content = _SECTION_BREAK_RE.sub(r'\1\2\n\3', content)
     
     # Ensure proper spacing between sections
-    content = re.sub(r'(\d+\.\s+[^\n]+)(\d+\.)', r'\1\n\n\2', content)
+    content = _SECTION_SPACING_RE.sub(r'\1\n\n\2', content)
     
     # Fix potential OCR issues with numbers
-    content = re.sub(r'([Oo]ne|[Tt]wo|[Tt]hree|[Ff]our|[Ff]ive)\s+(\w+)', r'1. \2', content)
+    content = _NUMBER_WORD_RE.sub(r'1. \2', content)
     
     return content
 
@@ -89,65 +150,45 @@ def extract_outline_structure(content: str) -> Dict[str, Any]:
     # Extract title (usually at the beginning)
     lines = content.split('\n')
     for i, line in enumerate(lines[:5]):
-        if line and not re.match(r'^\d+\.|^•|^-', line):
+        if line and not _NON_TITLE_RE.match(line):
             structure["title"] = line.strip()
             break
     
-    # Extract segments
+    # Extract segments, remembering where each one starts in the content
     segments = []
-    current_segment = None
-    
-    # Common patterns in workshop outlines
-    segment_pattern = re.compile(r'^\s*(\d+)\.\s+(.*?)(?:\s*\((\d+)\s*(?:min|minutes|minute)\))?', re.MULTILINE)
-    bullet_pattern = re.compile(r'^\s*[•\-]\s+(.*?)$', re.MULTILINE)
+    segment_starts = []
     
     # Find all segments
-    for match in segment_pattern.finditer(content):
+    for match in _SEGMENT_RE.finditer(content):
         number, title, duration_str = match.groups()
         
-        # Save previous segment if exists
-        if current_segment:
-            segments.append(current_segment)
-        
         # Parse duration
         duration = int(duration_str) if duration_str else 0
         
         # Create new segment
-        current_segment = {
+        segments.append({
             "title": title.strip(),
             "duration": duration,
             "subsections": [],
             "content": []
-        }
+        })
+        segment_starts.append(match.start())
     
-    # Add the last segment
-    if current_segment:
-        segments.append(current_segment)
-    
-    # Extract subsections
-    for i, segment in enumerate(segments):
-        # Get segment content
-        if i < len(segments) - 1:
-            segment_pattern = re.compile(fr'{segment["title"]}.*?(?={segments[i+1]["title"]})', re.DOTALL)
-        else:
-            segment_pattern = re.compile(fr'{segment["title"]}.*', re.DOTALL)
-        
-        segment_match = segment_pattern.search(content)
-        if segment_match:
-            segment_content = segment_match.group(0)
-            
-            # Find bullet points
-            for bullet_match in bullet_pattern.finditer(segment_content):
-                subsection = bullet_match.group(1).strip()
-                segment["subsections"].append(subsection)
+    # Extract subsections: a segment's content runs up to the next segment's start
+    segment_ends = segment_starts[1:] + [len(content)]
+    for segment, start, end in zip(segments, segment_starts, segment_ends):
+        # Find bullet points
+        for bullet_match in _BULLET_RE.finditer(content, start, end):
+            subsection = bullet_match.group(1).strip()
+            segment["subsections"].append(subsection)
     
     structure["segments"] = segments
     
     # Detect format style
     structure["format_style"] = {
         "uses_bullets": '•' in content,
-        "uses_numbered_sections": bool(segment_pattern.search(content)),
-        "uses_timing": bool(re.search(r'\(\d+\s*(?:min|minutes|minute)\)', content)),
+        "uses_numbered_sections": bool(_SEGMENT_RE.search(content)),
+        "uses_timing": bool(_TIMING_RE.search(content)),
         "capitalization": _detect_capitalization_style(segments)
     }
     
@@ -165,7 +206,7 @@ def _detect_capitalization_style(segments: List[Dict[str, Any]]) -> str:
         title = segment.get("title", "")
         if title.isupper():
             uppercase_count += 1
-        elif title[0].isupper() and not title.isupper():
+        elif title[:1].isupper():  # Not all uppercase, checked above
             titlecase_count += 1
     
     if uppercase_count > titlecase_count:
@@ -182,26 +223,25 @@ def chunk_pdf_for_embeddings(content: str) -> List[str]:
     Returns a list of chunks suitable for embedding generation
     """
     # Split by segments first
-    segment_pattern = re.compile(r'(\d+\.\s+.*?)(?=\d+\.\s+|$)', re.DOTALL)
-    segments = segment_pattern.findall(content)
+    segments = _CHUNK_SEGMENT_RE.findall(content)
     
     chunks = []
     for segment in segments:
         # If segment is too long, split further
         if len(segment) > 1000:
-            # Split by paragraphs
-            paragraphs = re.split(r'\n\s*\n', segment)
-            current_chunk = ""
+            # Split by paragraphs, packing consecutive paragraphs into chunks
+            # and joining each chunk once
+            paragraphs = _PARAGRAPH_BREAK_RE.split(segment)
+            chunk_start = 0
+            chunk_length = 0  # Length of the chunk's paragraphs plus separators
             
-            for para in paragraphs:
-                if len(current_chunk) + len(para) < 1000:
-                    current_chunk += para + "\n\n"
-                else:
-                    chunks.append(current_chunk.strip())
-                    current_chunk = para + "\n\n"
+            for i, para in enumerate(paragraphs):
+                if chunk_length + len(para) >= 1000 and i > chunk_start:
+                    chunks.append("\n\n".join(paragraphs[chunk_start:i]).strip())
+                    chunk_start, chunk_length = i, 0
+                chunk_length += len(para) + 2
             
-            if current_chunk:
-                chunks.append(current_chunk.strip())
+            chunks.append("\n\n".join(paragraphs[chunk_start:]).strip())
         else:
             chunks.append(segment.strip())
     
@@ -228,28 +268,59 @@ def process_pdf_for_rag(pdf_path: str) -> Tuple[str, Dict[str, Any], List[Dict[s
     raw_chunks = chunk_pdf_for_embeddings(content)
     
     # Prepare chunks with metadata
+    title_automaton = _build_title_automaton(structure)
     chunks_with_metadata = []
     for i, chunk in enumerate(raw_chunks):
         chunks_with_metadata.append({
             "content": chunk,
             "index": i,
             "source": "pdf",
-            "segment_info": _identify_segment_info(chunk, structure)
+            "segment_info": _identify_segment_info(chunk, structure, title_automaton)
         })
     
     return content, structure, chunks_with_metadata
 
-def _identify_segment_info(chunk: str, structure: Dict[str, Any]) -> Dict[str, Any]:
+def _build_title_automaton(structure: Dict[str, Any]) -> Optional[ahocorasick.Automaton]:
+    """
+    Build an Aho-Corasick automaton over the segment titles of a document
+    
+    Returns:
+        Automaton mapping each distinct title to its segment indices, or None
+        if no segment has a title
+    """
+    automaton = ahocorasick.Automaton()
+    for i, segment in enumerate(structure.get("segments", [])):
+        title = segment.get("title", "")
+        if title:
+            if title in automaton:
+                automaton.get(title).append(i)
+            else:
+                automaton.add_word(title, [i])
+    
+    if not len(automaton):
+        return None
+    automaton.make_automaton()
+    return automaton
+
+def _identify_segment_info(chunk: str, structure: Dict[str, Any],
+                           title_automaton: Optional[ahocorasick.Automaton] = None) -> Dict[str, Any]:
     """Identify which segment(s) this chunk belongs to"""
     segment_info = {
         "segment_titles": [],
         "segment_indices": []
     }
     
-    for i, segment in enumerate(structure.get("segments", [])):
-        title = segment.get("title", "")
-        if title and title in chunk:
-            segment_info["segment_titles"].append(title)
-            segment_info["segment_indices"].append(i)
+    if title_automaton is None:
+        title_automaton = _build_title_automaton(structure)
+        if title_automaton is None:
+            return segment_info
+    
+    # One pass over the chunk finds every title it contains
+    indices = sorted({i for _, title_indices in title_automaton.iter(chunk) for i in title_indices})
+    
+    segments = structure.get("segments", [])
+    for i in indices:
+        segment_info["segment_titles"].append(segments[i]["title"])
+        segment_info["segment_indices"].append(i)
     
     return segment_info
@@ -0,0 +1,215 @@
+"""
+Reference Corpus
+----------------
+Column-oriented view of the style and segment patterns of every reference
+outline, so pattern extraction runs as NumPy reductions instead of walking
+ORM objects and decoding their JSON structures on every request.
+"""
+
+import functools
+import threading
+import numpy as np
+import tiktoken
+from typing import Dict, List, Any, Tuple
+from sqlalchemy import event, inspect
+
+from app import db
+from app.models import ReferenceOutline
+from app._patterns import SEGMENT_TYPE_RE
+
+# Boolean format style keys, in bit order of the packed style flags
+STYLE_FLAGS = ('uses_bullets', 'uses_numbered_sections', 'uses_timing', 'uses_colons')
+
+# Tokenizer of the generation models, used for reference token IDs and
+# prompt budgeting
+TOKEN_ENCODING = 'cl100k_base'
+
+@functools.lru_cache(maxsize=1)
+def get_token_encoding() -> tiktoken.Encoding:
+    """The prompt budgeting tokenizer, loaded on first use"""
+    return tiktoken.get_encoding(TOKEN_ENCODING)
+
+def pack_style_flags(style: Dict[str, Any]) -> int:
+    """Pack the boolean format style keys into one integer, bit i = STYLE_FLAGS[i]"""
+    return sum(1 << i for i, key in enumerate(STYLE_FLAGS) if style.get(key, False))
+
+def summarize_structure(structure: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Precompute the per-outline summaries used for generation.
+
+    Args:
+        structure: Parsed structure of a reference outline
+
+    Returns:
+        Tuple of the format style and the segment patterns (lowercased title
+        sequence, distinct positive durations, distinct segment types)
+    """
+    structure = structure or {}
+    sequence, durations, segment_types = [], set(), []
+
+    for segment in structure.get('segments', []):
+        title = segment.get('title', '').lower()
+        sequence.append(title)
+
+        if segment.get('duration', 0) > 0:
+            durations.add(segment['duration'])
+
+        type_match = SEGMENT_TYPE_RE.match(title)
+        if type_match and type_match.lastgroup not in segment_types:
+            segment_types.append(type_match.lastgroup)
+
+    patterns = {
+        'sequence': sequence,
+        'durations': sorted(durations),
+        'segment_types': segment_types
+    }
+    return structure.get('format_style', {}), patterns
+
+
+class ReferenceCorpus:
+    """
+    Dense columns built from the stored summaries of the reference outlines
+    selected so far.
+
+    Per-outline columns: ids, style_flags (uint8), has_style, capitalization.
+    Ragged columns: titles (the lowercased segment sequence), durations (int32)
+    and segment_types, each with offsets locating every outline's values.
+
+    A summary is loaded the first time its outline is selected and kept with
+    the updated_at it was read at. Callers select outlines by (id, updated_at),
+    as read from the database, so an outline written since, by this or any
+    other process, is reloaded; only new and changed rows are ever read.
+    """
+
+    def __init__(self):
+        # Outline ID -> (updated_at, style, style_bits, patterns)
+        self._summaries: Dict[int, Tuple[Any, Dict[str, Any], int, Dict[str, Any]]] = {}
+        self._columns = None
+        self._row_by_id: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def select(self, references: List[Tuple[int, Any]]) -> Dict[str, np.ndarray]:
+        """
+        Get the columns for a set of reference outlines.
+
+        Args:
+            references: (id, updated_at) of each reference outline, in the
+                order rows should be returned
+
+        Returns:
+            Per-outline columns plus the concatenated ragged columns, and
+            segment_counts giving the length of each outline's title sequence
+        """
+        with self._lock:
+            stale = [outline_id for outline_id, updated_at in references
+                     if outline_id not in self._summaries
+                     or self._summaries[outline_id][0] != updated_at]
+            if stale:
+                self._load(stale)
+            if self._columns is None:
+                self._build()
+            cols, row_by_id = self._columns, self._row_by_id
+
+        rows = np.array([row_by_id[i] for i, _ in references if i in row_by_id], dtype=np.int64)
+        titles, segment_counts = self._ragged(cols, 'titles', rows)
+        durations, _ = self._ragged(cols, 'durations', rows)
+        segment_types, _ = self._ragged(cols, 'segment_types', rows)
+
+        return {
+            'style_flags': cols['style_flags'][rows],
+            'has_style': cols['has_style'][rows],
+            'capitalization': cols['capitalization'][rows],
+            'segment_counts': segment_counts,
+            'titles': titles,
+            'durations': durations,
+            'segment_types': segment_types,
+        }
+
+    def _ragged(self, cols: Dict[str, np.ndarray], name: str, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Concatenate the values of a ragged column for rows, with per-row counts"""
+        values = cols[name]
+        offsets = cols[name + '_offsets']
+        starts = offsets[rows]
+        ends = offsets[rows + 1]
+        value_rows = (np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+                      if len(rows) else np.empty(0, dtype=np.int64))
+        return values[value_rows], ends - starts
+
+    def _load(self, outline_ids: List[int]):
+        """Read the summaries of these outlines, dropping any that no longer exist"""
+        found = set()
+        missing = {}
+        for outline_id, updated_at, style, style_bits, patterns in db.session.query(
+                ReferenceOutline.id, ReferenceOutline.updated_at, ReferenceOutline.style_json,
+                ReferenceOutline.style_bits, ReferenceOutline.patterns_json).filter(
+                ReferenceOutline.id.in_(outline_ids)):
+            found.add(outline_id)
+            if patterns is None:
+                missing[outline_id] = updated_at
+            else:
+                style = style or {}
+                if style_bits is None:
+                    style_bits = pack_style_flags(style)
+                self._summaries[outline_id] = (updated_at, style, style_bits, patterns)
+
+        # Outlines stored before summaries existed are summarized from their structure
+        if missing:
+            for outline_id, structure in ReferenceOutline.load_many_structures(list(missing)).items():
+                style, patterns = summarize_structure(structure)
+                self._summaries[outline_id] = (missing[outline_id], style, pack_style_flags(style), patterns)
+
+        for outline_id in outline_ids:
+            if outline_id not in found:
+                self._summaries.pop(outline_id, None)
+        self._columns = None
+
+    def _build(self):
+        """Lay the loaded summaries out as columns"""
+        ids, style_flags, has_style, capitalization = [], [], [], []
+        ragged = {'titles': [], 'durations': [], 'segment_types': []}
+        offsets = {name: [0] for name in ragged}
+
+        for outline_id, (_, style, bits, patterns) in self._summaries.items():
+            ids.append(outline_id)
+            style_flags.append(bits)
+            has_style.append(bool(style))
+            capitalization.append(style.get('capitalization', 'unknown'))
+
+            for name, key in (('titles', 'sequence'), ('durations', 'durations'), ('segment_types', 'segment_types')):
+                ragged[name].extend(patterns.get(key, []))
+                offsets[name].append(len(ragged[name]))
+
+        columns = {
+            'ids': np.array(ids, dtype=np.int64),
+            'style_flags': np.array(style_flags, dtype=np.uint8),
+            'has_style': np.array(has_style, dtype=bool),
+            'capitalization': np.array(capitalization, dtype=object),
+            'titles': np.array(ragged['titles'], dtype=object),
+            'durations': np.array(ragged['durations'], dtype=np.int32),
+            'segment_types': np.array(ragged['segment_types'], dtype=object),
+        }
+        for name, name_offsets in offsets.items():
+            columns[name + '_offsets'] = np.array(name_offsets, dtype=np.int64)
+        self._columns = columns
+        self._row_by_id = {outline_id: row for row, outline_id in enumerate(ids)}
+
+
+reference_corpus = ReferenceCorpus()
+
+@event.listens_for(ReferenceOutline, 'before_insert')
+@event.listens_for(ReferenceOutline, 'before_update')
+def _summarize_reference_outline(mapper, connection, target):
+    # Style and patterns are computed once when the structure is written,
+    # never on the generation path
+    if (target.patterns_json is None or target.style_bits is None
+            or inspect(target).attrs.structure.history.has_changes()):
+        target.style_json, target.patterns_json = summarize_structure(target.structure)
+        target.style_bits = pack_style_flags(target.style_json)
+
+@event.listens_for(ReferenceOutline, 'before_insert')
+@event.listens_for(ReferenceOutline, 'before_update')
+def _tokenize_reference_outline(mapper, connection, target):
+    # Token IDs are computed once when the content is written, so the
+    # generation path only reads them
+    if target.tokens is None or inspect(target).attrs.content.history.has_changes():
+        target.tokens = get_token_encoding().encode(target.content)
@@ -4,6 +4,42 @@ API Routes for Programme Outline Generator (Continued)
 Flask routes for handling API requests.
 """
 
+import io
+import json
+
+from flask import request, jsonify, Response, stream_with_context, send_file
+
+from app import app, db
+from app.models import ReferenceOutline, GeneratedOutline, fetch_reference_summaries
+from app.outline_generator import OutlineGenerator
+from app.outline_parser import EmbeddingGenerator
+
+# Shared by every request: both keep caches and pooled state across requests
+outline_generator = OutlineGenerator()
+embedding_generator = EmbeddingGenerator()
+
+def parse_total_duration(value) -> int:
+    """
+    Read a total duration in minutes from request data. Form inputs send
+    numbers as strings, so "90" is accepted as well as 90.
+    
+    Args:
+        value: The totalDuration value from the request
+        
+    Returns:
+        The duration as a positive integer
+        
+    Raises:
+        ValueError: If the value is not a positive whole number
+    """
+    try:
+        duration = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"totalDuration must be a whole number of minutes, got {value!r}")
+    if duration <= 0:
+        raise ValueError(f"totalDuration must be positive, got {duration}")
+    return duration
+
 # API Routes for Generated Outlines (continued)
 @app.route('/api/generate', methods=['POST'])
 def generate_outline():
@@ -17,10 +53,17 @@ def generate_outline():
             'error': 'No data provided'
         }), 400
     
+    try:
+        total_duration = parse_total_duration(data.get('totalDuration', 120))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
     # Extract specifications
     title = data.get('title', 'New Workshop')
     objectives = data.get('objectives', '')
-    total_duration = data.get('totalDuration', 120)
     segments = data.get('segments', [])
     style_adherence = float(data.get('styleAdherence', 0.8))
     reference_ids = data.get('referenceIds', [])
@@ -36,11 +79,10 @@ def generate_outline():
     # Get reference outlines
     reference_outlines = []
     if reference_ids:
-        reference_outlines = ReferenceOutline.query.filter(ReferenceOutline.id.in_(reference_ids)).all()
+        reference_outlines = fetch_reference_summaries(reference_ids)
     else:
         # Use embeddings to find similar outlines if no specific references provided
-        # This is a simplification - in a real app, we'd do proper embedding similarity search
-        reference_outlines = ReferenceOutline.query.limit(3).all()
+        reference_outlines = find_reference_outlines(specifications)
     
     # Generate the outline
     generated_content = outline_generator.generate_outline(
@@ -67,6 +109,165 @@ def generate_outline():
         'content': generated_content
     })
 
+def find_reference_outlines(specifications, top_n=3):
+    """
+    Pick the reference outlines whose stored embeddings are closest to the
+    specifications.
+    
+    Args:
+        specifications: Specifications dictionary for the new outline
+        top_n: Number of reference outlines to return
+        
+    Returns:
+        List of reference summaries, most similar first
+    """
+    # Stored embeddings are loaded again only after a reference is written; at
+    # startup the index on disk is used if it covers the same references
+    if embedding_generator.needs_reference_embeddings:
+        references = (db.session.query(ReferenceOutline.id, ReferenceOutline.updated_at)
+                      .filter(ReferenceOutline.embedding.isnot(None)).all())
+        if not embedding_generator.adopt_reference_index(references):
+            rows = [
+                row for row in db.session.query(ReferenceOutline.id, ReferenceOutline.embedding,
+                                                ReferenceOutline.updated_at)
+                if row.embedding is not None
+            ]
+            embedding_generator.set_reference_embeddings(
+                [(row.id, row.embedding) for row in rows],
+                [row.updated_at for row in rows]
+            )
+    if not embedding_generator.has_reference_embeddings:
+        return fetch_reference_summaries(limit=top_n)
+    
+    # Embed the specifications, objectives included, in the shape of a reference's text
+    query_embedding = embedding_generator.generate_query_embedding(specifications)
+    
+    similar_ids = embedding_generator.find_similar_outlines(query_embedding, top_n=top_n)
+    return fetch_reference_summaries(similar_ids)
+
+@app.route('/api/generate/stream', methods=['POST'])
+def stream_generated_outline():
+    """Generate a new outline, streaming it as server-sent events"""
+    data = request.json
+    
+    if not data:
+        return jsonify({
+            'success': False,
+            'error': 'No data provided'
+        }), 400
+    
+    try:
+        total_duration = parse_total_duration(data.get('totalDuration', 120))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    specifications = {
+        'title': data.get('title', 'New Workshop'),
+        'objectives': data.get('objectives', ''),
+        'total_duration': total_duration,
+        'segments': data.get('segments', [])
+    }
+    style_adherence = float(data.get('styleAdherence', 0.8))
+    reference_ids = data.get('referenceIds', [])
+    
+    if reference_ids:
+        reference_outlines = fetch_reference_summaries(reference_ids)
+    else:
+        reference_outlines = find_reference_outlines(specifications)
+    
+    def events():
+        parts = []
+        for chunk in outline_generator.stream_outline(specifications, reference_outlines, style_adherence):
+            parts.append(chunk)
+            yield f"data: {json.dumps({'content': chunk})}\n\n"
+        
+        # Save the complete outline once streaming has finished
+        outline = GeneratedOutline(
+            title=specifications['title'],
+            objectives=specifications['objectives'],
+            total_duration=specifications['total_duration'],
+            specifications=specifications,
+            content="".join(parts).strip(),
+            reference_id=reference_outlines[0].id if reference_outlines else None,
+            user_id=None
+        )
+        db.session.add(outline)
+        db.session.commit()
+        
+        yield f"event: done\ndata: {json.dumps({'outline': outline.to_dict()})}\n\n"
+    
+    return Response(stream_with_context(events()), mimetype='text/event-stream')
+
+@app.route('/api/generate/batch', methods=['POST'])
+async def generate_outlines_batch():
+    """Generate several outlines concurrently from a list of specifications"""
+    data = request.json
+    
+    if not data or not data.get('specifications'):
+        return jsonify({
+            'success': False,
+            'error': 'No specifications provided'
+        }), 400
+    
+    style_adherence = float(data.get('styleAdherence', 0.8))
+    reference_ids = data.get('referenceIds', [])
+    
+    # Create one specifications dictionary per requested outline
+    try:
+        specifications_list = [
+            {
+                'title': spec.get('title', 'New Workshop'),
+                'objectives': spec.get('objectives', ''),
+                'total_duration': parse_total_duration(spec.get('totalDuration', 120)),
+                'segments': spec.get('segments', [])
+            }
+            for spec in data['specifications']
+        ]
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    # Get reference outlines shared by every outline in the batch
+    if reference_ids:
+        reference_outlines = fetch_reference_summaries(reference_ids)
+    else:
+        reference_outlines = fetch_reference_summaries(limit=3)
+    
+    # Generate all outlines concurrently
+    generated_contents = await outline_generator.abatch_generate(
+        specifications_list, reference_outlines, style_adherence
+    )
+    
+    # Save the generated outlines
+    outlines = []
+    for specifications, generated_content in zip(specifications_list, generated_contents):
+        outline = GeneratedOutline(
+            title=specifications['title'],
+            objectives=specifications['objectives'],
+            total_duration=specifications['total_duration'],
+            specifications=specifications,
+            content=generated_content,
+            reference_id=reference_outlines[0].id if reference_outlines else None,
+            user_id=None
+        )
+        db.session.add(outline)
+        outlines.append(outline)
+    
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'outlines': [
+            {'outline': outline.to_dict(), 'content': outline.content}
+            for outline in outlines
+        ]
+    })
+
 @app.route('/api/outlines', methods=['GET'])
 def get_outlines():
     """Get all generated outlines"""
@@ -106,7 +307,13 @@ def update_outline(outline_id):
     if 'objectives' in data:
         outline.objectives = data['objectives']
     if 'totalDuration' in data:
-        outline.total_duration = data['totalDuration']
+        try:
+            outline.total_duration = parse_total_duration(data['totalDuration'])
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
     
     db.session.commit()
     
@@ -154,11 +361,11 @@ def regenerate_segment(outline_id):
     reference_outlines = []
     
     if reference_ids:
-        reference_outlines = ReferenceOutline.query.filter(ReferenceOutline.id.in_(reference_ids)).all()
+        reference_outlines = fetch_reference_summaries(reference_ids)
     elif outline.reference_id:
-        reference_outlines = [ReferenceOutline.query.get(outline.reference_id)]
+        reference_outlines = fetch_reference_summaries([outline.reference_id])
     else:
-        reference_outlines = ReferenceOutline.query.limit(3).all()
+        reference_outlines = fetch_reference_summaries(limit=3)
     
     # Regenerate the segment
     updated_content = outline_generator.regenerate_segment(
@@ -175,6 +382,50 @@ def regenerate_segment(outline_id):
         'content': updated_content
     })
 
+@app.route('/api/outlines/<int:outline_id>/regenerate-segments', methods=['POST'])
+async def regenerate_segments(outline_id):
+    """Regenerate several segments of an outline concurrently"""
+    outline = GeneratedOutline.query.get_or_404(outline_id)
+    data = request.json
+    
+    if not data or not data.get('segments'):
+        return jsonify({
+            'success': False,
+            'error': 'No segments provided'
+        }), 400
+    
+    # Map segment index -> segment specifications
+    segment_specs = {
+        seg['segmentIndex']: seg.get('segmentSpecs', {})
+        for seg in data['segments']
+        if seg.get('segmentIndex') is not None
+    }
+    
+    # Get reference outlines
+    reference_ids = data.get('referenceIds', [])
+    
+    if reference_ids:
+        reference_outlines = fetch_reference_summaries(reference_ids)
+    elif outline.reference_id:
+        reference_outlines = fetch_reference_summaries([outline.reference_id])
+    else:
+        reference_outlines = fetch_reference_summaries(limit=3)
+    
+    # Regenerate all segments concurrently
+    updated_content = await outline_generator.aregenerate_segments(
+        outline.content, segment_specs, reference_outlines
+    )
+    
+    # Update the outline
+    outline.content = updated_content
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'outline': outline.to_dict(),
+        'content': updated_content
+    })
+
 # Export Routes
 @app.route('/api/outlines/<int:outline_id>/export', methods=['GET'])
 def export_outline(outline_id):
@@ -206,6 +457,13 @@ def export_as_pdf(outline):
     pdf.set_font('Arial', 'B', 16)
     pdf.cell(0, 10, outline.title, 0, 1, 'C')
     
+    def write_line(line):
+        # Only lines wider than the space left on the row need word wrapping
+        if pdf.get_string_width(line) <= pdf.w - pdf.r_margin - pdf.get_x():
+            pdf.cell(0, 10, line, 0, 1)
+        else:
+            pdf.multi_cell(0, 10, line)
+    
     # Add objectives
     pdf.set_font('Arial', 'B', 12)
     pdf.cell(0, 10, 'Objectives:', 0, 1, 'L')
@@ -214,12 +472,12 @@ def export_as_pdf(outline):
     # Split objectives into multiple lines if needed
     objectives = outline.objectives.strip().split('\n')
     for obj in objectives:
-        pdf.multi_cell(0, 10, obj)
+        write_line(obj)
     
     pdf.ln(10)
     
-    # Add content
-    pdf.set_font('Arial', '', 12)
+    # Add content; the font only changes between headings and body text
+    font_style = ''
     
     # Replace bullet points and handle formatting
     content_lines = outline.content.strip().split('\n')
@@ -230,16 +488,16 @@ def export_as_pdf(outline):
             continue
         
         # Check if line is a heading
-        if line.startswith(('1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.', '9.')):
-            pdf.set_font('Arial', 'B', 12)
-            pdf.multi_cell(0, 10, line)
-            pdf.set_font('Arial', '', 12)
+        is_heading = line.startswith(('1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.', '9.'))
+        style = 'B' if is_heading else ''
+        if style != font_style:
+            pdf.set_font('Arial', style, 12)
+            font_style = style
+        
         # Check if line is a bullet point
-        elif line.startswith('•'):
+        if not is_heading and line.startswith('•'):
             pdf.set_x(15)  # Indent
-            pdf.multi_cell(0, 10, line)
-        else:
-            pdf.multi_cell(0, 10, line)
+        write_line(line)
     
     # Output PDF to a BytesIO object
     output = io.BytesIO()
@@ -317,6 +575,11 @@ def export_as_text(outline):
 Integration of PDF processing with API routes for Programme Outline Generator
 """
 
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.utils import secure_filename
+
 from app.pdf_improvements import enhance_pdf_extraction, extract_outline_structure
 
 # Update this function in api_routes.py in the create_reference route
@@ -373,6 +636,88 @@ def parse_reference_outline(content, filepath=None, filename=None):
     
     return structure
 
+def load_reference_file(filepath, filename):
+    """
+    Extract and parse an uploaded reference file. Runs in a worker process.
+    
+    Args:
+        filepath: Path to the uploaded file
+        filename: Name of the uploaded file
+        
+    Returns:
+        Tuple of extracted content and parsed structure
+    """
+    content = process_uploaded_file(filepath, filename)
+    return content, parse_reference_outline(content, filepath, filename)
+
+# Worker processes for CPU-bound extraction and parsing, created on first upload
+_ingest_executor = None
+
+def get_ingest_executor():
+    """Process pool shared by reference uploads"""
+    global _ingest_executor
+    if _ingest_executor is None:
+        _ingest_executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _ingest_executor
+
+@app.route('/api/references/batch', methods=['POST'])
+async def create_references_batch():
+    """Create reference outlines from several uploaded files at once"""
+    files = request.files.getlist('files')
+    
+    uploads = []
+    for file in files:
+        filename = secure_filename(file.filename or '')
+        if not filename:
+            continue
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        file.save(filepath)
+        uploads.append((filepath, filename))
+    
+    if not uploads:
+        return jsonify({
+            'success': False,
+            'error': 'No files provided'
+        }), 400
+    
+    # Extract and parse the files in parallel worker processes
+    loop = asyncio.get_running_loop()
+    executor = get_ingest_executor()
+    try:
+        parsed = await asyncio.gather(*(
+            loop.run_in_executor(executor, load_reference_file, filepath, filename)
+            for filepath, filename in uploads
+        ))
+    except Exception as e:
+        app.logger.error(f"Error processing uploaded files: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': f'Error processing uploaded files: {str(e)}'
+        }), 500
+    
+    # Embed every reference with as few requests as possible
+    embeddings = await embedding_generator.agenerate_outline_embeddings(parsed)
+    
+    # Create the reference outlines
+    references = []
+    for (filepath, filename), (content, structure), embedding in zip(uploads, parsed, embeddings):
+        reference = ReferenceOutline(
+            title=structure.get('title') or filename,
+            description=request.form.get('description', ''),
+            content=content,
+            structure=structure,
+            embedding=embedding
+        )
+        db.session.add(reference)
+        references.append(reference)
+    
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'references': [reference.to_dict() for reference in references]
+    })
+
 # Replace the related code in the create_reference route:
 """
 @app.route('/api/references', methods=['POST'])
@@ -2,32 +2,178 @@
 Configuration settings for the Programme Outline Generator
 """
 
+import hashlib
 import os
-from dotenv import load_dotenv
+import warnings
+from types import MappingProxyType
+from typing import Final, Mapping, Optional, Type
 
-# Load environment variables from .env file
-load_dotenv()
+# Project and app package directories, resolved once for every path setting
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_APP_DIR = os.path.join(_BASE_DIR, 'app')
 
-class Config:
-    """Base configuration"""
-    # Flask
-    SECRET_KEY = os.environ.get('SECRET_KEY', 'dev_key_for_session_management')
+def _compiled_dotenv() -> Optional[dict]:
+    """
+    Variables of the .env compiled by tools/compile_env.py, if that module
+    exists and was compiled from the current .env.
     
-    # Database
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///outline_generator.db')
+    Returns:
+        The compiled variables, or None when .env has to be parsed instead
+    """
+    try:
+        import env_compiled
+    except ImportError:
+        return None
+    
+    try:
+        with open(os.path.join(_BASE_DIR, '.env'), 'rb') as env_file:
+            digest = hashlib.blake2b(env_file.read(), digest_size=16).hexdigest()
+    except FileNotFoundError:
+        digest = None
+    
+    if digest is None or getattr(env_compiled, 'SOURCE_DIGEST', None) != digest:
+        warnings.warn("env_compiled.py is out of date with .env and is ignored; "
+                      "re-run tools/compile_env.py")
+        return None
+    return env_compiled.ENV
+
+_TRUE_VALUES = frozenset({'1', 'true', 'yes', 'on'})
+_FALSE_VALUES = frozenset({'', '0', 'false', 'no', 'off'})
+
+def _parse_flag(name: str, value: Optional[str], default: bool) -> bool:
+    """
+    Parse a boolean environment variable.
+    
+    Args:
+        name: Name of the environment variable, for the error message
+        value: Its value, or None when it is not set
+        default: Value when the variable is not set
+        
+    Returns:
+        The flag; "1"/"true"/"yes"/"on" enable it and "0"/"false"/"no"/"off"
+        (or an empty value) disable it, in any case
+        
+    Raises:
+        ValueError: If the variable holds any other value
+    """
+    if value is None:
+        return default
+    value = value.strip().lower()
+    if value in _TRUE_VALUES:
+        return True
+    if value in _FALSE_VALUES:
+        return False
+    raise ValueError(f"{name} must be a boolean (1/0, true/false, yes/no, on/off), got {value!r}")
+
+# Load environment variables from .env file, unless the environment is
+# already populated (FLASK_SKIP_DOTENV=1, as set in the production image).
+# A .env compiled by tools/compile_env.py is imported instead of parsed;
+# like load_dotenv(), it never overrides variables that are already set.
+if not _parse_flag('FLASK_SKIP_DOTENV', os.environ.get('FLASK_SKIP_DOTENV'), False):
+    _DOTENV = _compiled_dotenv()
+    if _DOTENV is None:
+        from dotenv import load_dotenv
+        load_dotenv()
+    else:
+        for _key, _value in _DOTENV.items():
+            os.environ.setdefault(_key, _value)
+
+# Snapshot of the environment, read once; settings are resolved from this
+# plain dict rather than through os.environ
+_ENV = os.environ.copy()
+
+# Defaults for settings missing (or empty) in the environment
+_DEFAULT_SECRET_KEY = 'dev_key_for_session_management'
+_DEFAULT_DATABASE_URL = 'sqlite:///outline_generator.db'
+
+class LazyEnv:
+    """
+    Config attribute computed on first access, so settings that are never
+    read are never computed. The compute function is passed the config
+    class the attribute is read from, and the value is remembered per class:
+    a setting derived from another one (engine options from the database
+    URI) follows the overrides of the subclass that reads it.
+    """
+    
+    def __init__(self, compute):
+        self.compute = compute
+        self.values = {}
+    
+    def __set_name__(self, owner, name):
+        self.name = name
+    
+    def __get__(self, instance, owner):
+        try:
+            return self.values[owner]
+        except KeyError:
+            value = self.values[owner] = self.compute(owner)
+            return value
+
+def _env_flag(name: str, default: bool) -> bool:
+    """Read a boolean setting from the environment snapshot (see _parse_flag)"""
+    return _parse_flag(name, _ENV.get(name), default)
+
+def _engine_options(database_uri: str) -> dict:
+    """SQLAlchemy engine options for a database URI"""
+    options = {'pool_pre_ping': True}
+    if database_uri.startswith('sqlite'):
+        # Connections are pooled and shared across request threads
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+def _required_secret_key() -> str:
+    """SECRET_KEY from the environment, which production must provide"""
+    secret_key = _ENV.get('SECRET_KEY')
+    if not secret_key:
+        raise RuntimeError("SECRET_KEY must be set in production")
+    return secret_key
+
+class _StaticConfig:
+    """Settings that are plain literals, independent of the environment"""
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
     # File uploads
-    UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+    UPLOAD_FOLDER = os.path.join(_APP_DIR, 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB max upload size
     
+    # Normalized reference embeddings, memory-mapped for similarity search
+    EMBEDDING_INDEX_FOLDER = os.path.join(_APP_DIR, 'embeddings')
+
+class _EnvConfig:
+    """Settings read from the environment, each on first access"""
+    # Flask
+    SECRET_KEY = LazyEnv(lambda cls: _ENV.get('SECRET_KEY') or _DEFAULT_SECRET_KEY)
+    
+    # Database
+    SQLALCHEMY_DATABASE_URI = LazyEnv(lambda cls: _ENV.get('DATABASE_URL') or _DEFAULT_DATABASE_URL)
+    SQLALCHEMY_ENGINE_OPTIONS = LazyEnv(lambda cls: _engine_options(cls.SQLALCHEMY_DATABASE_URI))
+    
+    # Tables are created at deploy time (flask db-init) unless
+    # AUTO_CREATE_TABLES=1 creates them when the app loads
+    AUTO_CREATE_TABLES = LazyEnv(lambda cls: _env_flag('AUTO_CREATE_TABLES', False))
+    
     # API keys
-    OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
+    OPENAI_API_KEY = LazyEnv(lambda cls: _ENV.get('OPENAI_API_KEY') or '')
+
+class Config(_StaticConfig, _EnvConfig):
+    """Base configuration"""
+    
+    @staticmethod
+    def refresh_env():
+        """
+        Re-read the environment snapshot after os.environ changes (e.g. in tests).
+        Settings already read from a config class keep their values.
+        """
+        global _ENV
+        _ENV = os.environ.copy()
 
 class DevelopmentConfig(Config):
     """Development configuration"""
     DEBUG = True
     
+    # Tables are created when the app loads, unless AUTO_CREATE_TABLES=0
+    AUTO_CREATE_TABLES = LazyEnv(lambda cls: _env_flag('AUTO_CREATE_TABLES', True))
+    
 class TestingConfig(Config):
     """Testing configuration"""
     TESTING = True
@@ -37,22 +183,37 @@ class ProductionConfig(Config):
     """Production configuration"""
     DEBUG = False
     
-    # Use stronger secret key in production
-    SECRET_KEY = os.environ.get('SECRET_KEY')
+    # Use stronger secret key in production; never fall back to the dev key
+    SECRET_KEY = LazyEnv(lambda cls: _required_secret_key())
     
     # Secure cookies
     SESSION_COOKIE_SECURE = True
     REMEMBER_COOKIE_SECURE = True
 
-# Configuration dictionary
-config = {
+# Configuration registry, read-only. Without FLASK_ENV the production
+# settings apply, so a misconfigured deploy never runs with DEBUG on;
+# development is opted into with FLASK_ENV=development
+config: Final[Mapping[str, Type[Config]]] = MappingProxyType({
     'development': DevelopmentConfig,
     'testing': TestingConfig,
     'production': ProductionConfig,
-    'default': DevelopmentConfig
-}
+    'default': ProductionConfig
+})
+
+def _resolve_config() -> Type[Config]:
+    env = _ENV.get('FLASK_ENV', 'default')
+    return config.get(env, config['default'])
+
+# Configuration for this process, resolved once at import since FLASK_ENV
+# does not change while the process runs
+ACTIVE_CONFIG: Type[Config] = _resolve_config()
 
 # Get configuration based on environment
 def get_config():
-    env = os.environ.get('FLASK_ENV', 'default')
-    return config.get(env)
+    return ACTIVE_CONFIG
+
+# Re-resolve the configuration, e.g. after a test changes FLASK_ENV
+def reset_config():
+    global ACTIVE_CONFIG
+    Config.refresh_env()
+    ACTIVE_CONFIG = _resolve_config()
@@ -4,12 +4,72 @@ Programme Outline Generator Web App
 Main application entry point
 """
 
+import os
+
+from sqlalchemy import inspect
+
+# config.py, loaded by the app, reads .env (unless FLASK_SKIP_DOTENV=1)
 from app import app, db
+from app import routes  # Registers the API routes
 
-# Create database tables
-@app.before_first_request
-def create_tables():
+def create_tables() -> list:
+    """Create any missing database tables and add missing nullable columns"""
+    from app import models  # Registers the tables with db.metadata
     db.create_all()
+    return add_missing_columns()
+
+def add_missing_columns() -> list:
+    """
+    Add columns introduced since a table was created. create_all() never
+    alters existing tables, so without this, queries on a database created
+    by an earlier version fail on the new columns.
+    
+    Only nullable columns can be added this way; existing rows get NULL,
+    which the code treats as "not computed yet".
+    
+    Returns:
+        Names of the added columns, as table.column
+    """
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    added = []
+    
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    app.logger.error(f"Cannot add non-nullable column {table.name}.{column.name}; migrate it manually")
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {preparer.format_table(table)} "
+                    f"ADD COLUMN {preparer.format_column(column)} {column_type}"
+                )
+                added.append(f"{table.name}.{column.name}")
+    
+    return added
+
+# Create database tables once at deploy time, and after upgrades: flask db-init
+@app.cli.command('db-init')
+def db_init():
+    """Create the database tables and add columns missing from existing ones."""
+    for column in create_tables():
+        print(f"Added column {column}")
+    print("Database tables created")
+
+# Development convenience: create tables when the app loads instead
+if app.config.get('AUTO_CREATE_TABLES'):
+    with app.app_context():
+        create_tables()
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Debug follows the configuration (FLASK_ENV/FLASK_DEBUG); the reloader,
+    # which re-imports the app in a child process, only runs with FLASK_RELOAD=1
+    app.run(debug=app.config.get('DEBUG', False),
+            use_reloader=os.environ.get('FLASK_RELOAD') == '1')
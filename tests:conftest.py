@@ -0,0 +1,8 @@
+"""
+Shared test setup
+"""
+
+import os
+
+# TestingConfig (in-memory database); must be set before the app is imported
+os.environ.setdefault('FLASK_ENV', 'testing')
@@ -0,0 +1,47 @@
+"""
+Tests for the configuration settings
+"""
+
+import pytest
+
+import config
+from config import _env_flag
+
+
+@pytest.fixture(autouse=True)
+def restore_env(monkeypatch):
+    """Re-read the environment once the test's changes are undone"""
+    yield
+    monkeypatch.undo()
+    config.Config.refresh_env()
+
+
+def test_engine_options_follow_the_subclass_database(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'postgresql://localhost/outlines')
+    config.Config.refresh_env()
+
+    # Reading the base class first must not fix the value for subclasses
+    assert 'connect_args' not in config.Config.SQLALCHEMY_ENGINE_OPTIONS
+    options = config.TestingConfig.SQLALCHEMY_ENGINE_OPTIONS
+    assert options['connect_args'] == {'check_same_thread': False}
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1', True), ('true', True), ('Yes', True), ('ON', True),
+    ('0', False), ('false', False), ('no', False), ('off', False), ('', False),
+])
+def test_env_flag_values(monkeypatch, value, expected):
+    monkeypatch.setenv('AUTO_CREATE_TABLES', value)
+    config.Config.refresh_env()
+    assert _env_flag('AUTO_CREATE_TABLES', not expected) is expected
+
+
+def test_env_flag_default_and_invalid(monkeypatch):
+    monkeypatch.delenv('AUTO_CREATE_TABLES', raising=False)
+    config.Config.refresh_env()
+    assert _env_flag('AUTO_CREATE_TABLES', True) is True
+
+    monkeypatch.setenv('AUTO_CREATE_TABLES', 'maybe')
+    config.Config.refresh_env()
+    with pytest.raises(ValueError):
+        _env_flag('AUTO_CREATE_TABLES', False)
@@ -0,0 +1,47 @@
+"""
+Tests for the outline generation routes
+"""
+
+import pytest
+
+from app import app, db
+from app import routes
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Test client with an empty database and no OpenAI calls"""
+    prompts = []
+
+    def complete_outline(prompt, model, max_tokens, specifications):
+        prompts.append((prompt, model, max_tokens))
+        return "1. Introduction (15 min)"
+
+    monkeypatch.setattr(routes.outline_generator, '_complete_outline', complete_outline)
+    monkeypatch.setattr(routes, 'find_reference_outlines', lambda specifications: [])
+    app.config['TESTING'] = True
+
+    with app.app_context():
+        db.create_all()
+        with app.test_client() as test_client:
+            test_client.prompts = prompts
+            yield test_client
+        db.session.remove()
+        db.drop_all()
+
+
+def test_generate_accepts_duration_as_string(client):
+    response = client.post('/api/generate', json={'title': 'Workshop', 'totalDuration': '90'})
+
+    assert response.status_code == 200
+    assert response.get_json()['outline']['total_duration'] == 90
+    _, _, max_tokens = client.prompts[0]
+    assert max_tokens == min(2000, 200 + 40 * 90)
+
+
+def test_generate_rejects_non_numeric_duration(client):
+    response = client.post('/api/generate', json={'title': 'Workshop', 'totalDuration': 'ninety'})
+
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+    assert client.prompts == []
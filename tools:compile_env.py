@@ -0,0 +1,54 @@
+"""
+Compile .env into env_compiled.py
+---------------------------------
+Writes the variables of the project's .env file as a Python dict, so
+config.py can import them (from cached bytecode) instead of parsing the
+.env file on every start. Run it again whenever .env changes; until then
+config.py warns and reads .env itself. The output holds the same secrets
+as .env, so it is kept out of git and the Docker image:
+
+    python tools/compile_env.py
+"""
+
+import hashlib
+import os
+import sys
+from pprint import pformat
+from dotenv import dotenv_values
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def compile_env(env_path: str, output_path: str) -> int:
+    """
+    Write the variables of a .env file to a Python module as ENV, with the
+    digest of the .env contents as SOURCE_DIGEST so config.py can tell when
+    the module is out of date.
+
+    Args:
+        env_path: Path of the .env file
+        output_path: Path of the module to write
+
+    Returns:
+        Number of variables written
+    """
+    # Keys declared without a value are left out, as load_dotenv() does
+    values = {key: value for key, value in dotenv_values(env_path).items() if value is not None}
+    with open(env_path, 'rb') as env_file:
+        source_digest = hashlib.blake2b(env_file.read(), digest_size=16).hexdigest()
+
+    with open(output_path, 'w', encoding='utf-8') as output:
+        output.write(f'"""Generated from {os.path.basename(env_path)} by tools/compile_env.py; do not edit"""\n\n')
+        output.write(f'SOURCE_DIGEST = {source_digest!r}\n')
+        output.write(f'ENV = {pformat(values)}\n')
+
+    return len(values)
+
+if __name__ == '__main__':
+    env_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(PROJECT_ROOT, '.env')
+    output_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(PROJECT_ROOT, 'env_compiled.py')
+
+    if not os.path.exists(env_path):
+        sys.exit(f"No .env file at {env_path}")
+
+    count = compile_env(env_path, output_path)
+    print(f"Wrote {count} variables to {output_path}")